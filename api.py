@@ -0,0 +1,184 @@
+"""台指選擇權分析 JSON API
+
+給機器人、PWA、儀表板等程式化用戶使用, 不需開啟 Streamlit session。
+
+兩種執行方式:
+  1. 內嵌: 設定 ANALYTICS_API_PORT 後, Streamlit 程序會在背景啟動本 API,
+     與頁面共用同一組快取 (背景更新快取、請求合併、合約批次預算)。
+  2. 獨立: python api.py [--port 8000], 供本機壓測 (例如 hey / ab / wrk);
+     記憶體快取獨立, 但仍共用歷史資料庫。
+
+端點:
+  GET /api/health
+  GET /api/contracts                    數據日與未結算合約
+  GET /api/contracts/{code}?spot=       單一合約分析含 Max Pain 痛苦曲線 (spot 未帶則用即時現貨)
+  GET /api/contracts/{code}/history     近 20 日未平倉: D1/D5/D20 變化、連續增倉天數、每日最大未平倉履約價
+  GET /api/institutional                法人期貨 / 選擇權淨部位與期貨價格
+  GET /api/status                       請求合併、快取、上游斷路與批次預算狀態
+"""
+import json
+import threading
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+API_HOST = "0.0.0.0"
+
+
+def frame_records(df, columns=None):
+    """DataFrame 轉 JSON 陣列 (NaN 轉 null, numpy 型別轉原生型別)"""
+    if df is None:
+        return None
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return json.loads(df.to_json(orient='records', force_ascii=False))
+
+
+def to_float(value):
+    """numpy 純量 / NaN 轉成可序列化的 float 或 None"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value == value else None
+
+
+def create_app(core):
+    """core 為提供數據與計算函式的模組 (app_fixed 或正在執行的 Streamlit 腳本)"""
+
+    def load_option_data():
+        all_option_data = core.get_option_data_multi_days(days=core.OI_HISTORY_DAYS)
+        if not all_option_data:
+            return None, []
+        data_date = all_option_data[0]['date']
+        return all_option_data, core.get_next_contracts(all_option_data[0]['df'], data_date)
+
+    def health(request):
+        return JSONResponse({'status': 'ok'})
+
+    def contracts(request):
+        all_option_data, targets = load_option_data()
+        if not all_option_data:
+            return JSONResponse({'error': '無法取得選擇權數據'}, status_code=503)
+        return JSONResponse({
+            'data_date': all_option_data[0]['date'],
+            'contracts': [
+                {'code': c['code'], 'settlement_date': c['date'], 'weekly': 'W' in c['code'] or 'F' in c['code']}
+                for c in targets
+            ],
+        })
+
+    def contract_detail(request):
+        code = request.path_params['code']
+        spot = request.query_params.get('spot')
+        try:
+            spot = float(spot) if spot else core.get_live_spot()
+        except ValueError:
+            return JSONResponse({'error': 'spot 必須為數字'}, status_code=400)
+        all_option_data, targets = load_option_data()
+        if not all_option_data:
+            return JSONResponse({'error': '無法取得選擇權數據'}, status_code=503)
+        if code not in {c['code'] for c in targets}:
+            return JSONResponse({'error': f'找不到未結算合約 {code}'}, status_code=404)
+        analytics = core.get_contract_analytics(all_option_data[0]['date'], code, spot, all_option_data)
+        if analytics is None:
+            return JSONResponse({'error': f'找不到 {code} 的數據'}, status_code=404)
+        oi_change_columns = [c for c in analytics['df'].columns if c.startswith('OI_Change_')]
+        return JSONResponse({
+            'data_date': analytics['data_date'],
+            'contract': code,
+            'settlement_date': analytics['settlement_date'],
+            'spot': to_float(spot),
+            'call_amount': to_float(analytics['call_amount']),
+            'put_amount': to_float(analytics['put_amount']),
+            'pc_ratio': to_float(analytics['pc_ratio']),
+            'atm_strike': to_float(analytics['atm_strike']),
+            'atm_iv': to_float(analytics['atm_iv']),
+            'risk_reversal': to_float(analytics['risk_reversal']),
+            'max_pain': analytics['max_pain'],
+            'chain': frame_records(analytics['df'], ['Strike', 'Type', 'OI', 'Price', 'Amount'] + oi_change_columns),
+            'gex': frame_records(analytics['gex']),
+            'gamma_flip': to_float(analytics['gamma_flip']),
+            'gex_profile': frame_records(analytics['gex_profile']),
+            'pain_curve': frame_records(analytics['pain_curve'], ['Strike', 'Call_Pain', 'Put_Pain', 'Pain']),
+        })
+
+    def contract_history(request):
+        code = request.path_params['code']
+        history_data = core.get_option_data_multi_days(days=core.OI_HISTORY_VIEW_DAYS)
+        if not history_data:
+            return JSONResponse({'error': '無法取得選擇權數據'}, status_code=503)
+        table, peaks = core.get_oi_history_view(history_data[0]['date'], code, len(history_data), history_data)
+        if table is None:
+            return JSONResponse({'error': f'找不到 {code} 的數據'}, status_code=404)
+        return JSONResponse({
+            'data_date': history_data[0]['date'],
+            'contract': code,
+            'days': len(history_data),
+            'strikes': frame_records(table),
+            'peaks': frame_records(peaks.rename_axis('date').reset_index()),
+        })
+
+    def institutional(request):
+        snapshot, futures_age = core.get_futures_contracts_snapshot.get_with_age()
+        inst_opt, options_age = core.get_institutional_option_data.get_with_age()
+        futures_price, _, futures_date = core.futures_data_from_snapshot(snapshot)
+        return JSONResponse({
+            'futures_price': to_float(futures_price),
+            'futures_date': futures_date,
+            'futures': core.institutional_futures_from_snapshot(snapshot),
+            'options': inst_opt,
+            'age': int(max(futures_age, options_age)),
+        })
+
+    def upstream_error(request, exc):
+        return JSONResponse({'error': '期交所連線失敗或逾時', 'detail': str(exc)}, status_code=503)
+
+    def status(request):
+        return JSONResponse({
+            'single_flight': frame_records(core.single_flight_stats().rename(columns={
+                '來源': 'source', '呼叫': 'calls', '實際請求': 'executions', '合併': 'coalesced'
+            })),
+            'caches': [
+                {'name': s['name'], 'age': int(s['age']), 'ttl': s['ttl'], 'refreshing': bool(s['refreshing'])}
+                for s in core.get_swr_cache().status()
+            ],
+            'upstream': frame_records(core.upstream_status().rename(columns={
+                '端點': 'endpoint', '狀態': 'state', '連續失敗': 'failures', '拒絕': 'rejected', '無資料日期': 'no_data_dates'
+            })),
+            'batches': frame_records(core.get_batch_log().summary().rename(columns={
+                '數據日': 'data_date', '現貨': 'spot', '合約數': 'contracts', '耗時(ms)': 'ms', '記憶體(KB)': 'kb'
+            })),
+        })
+
+    return Starlette(routes=[
+        Route('/api/health', health),
+        Route('/api/contracts', contracts),
+        Route('/api/contracts/{code}', contract_detail),
+        Route('/api/contracts/{code}/history', contract_history),
+        Route('/api/institutional', institutional),
+        Route('/api/status', status),
+    ], exception_handlers={core.UpstreamError: upstream_error})
+
+
+def serve_in_background(core, port, host=API_HOST):
+    """以 daemon 執行緒啟動 uvicorn, 回傳 uvicorn.Server"""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(create_app(core), host=host, port=port, log_level='warning'))
+    threading.Thread(target=server.run, name='analytics-api', daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import uvicorn
+
+    import app_fixed
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    uvicorn.run(create_app(app_fixed), host=args.host, port=args.port)
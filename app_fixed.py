@@ -1,19 +1,31 @@
 import streamlit as st
 import pandas as pd
-import plotly.graph_objects as go
 import requests
 import time
 from datetime import datetime, timedelta, timezone
 from io import StringIO
 import calendar
 import re
-import google.generativeai as genai
-from openai import OpenAI
-import streamlit.components.v1 as components
 import numpy as np
-from scipy.stats import norm
 import urllib3
+from requests.adapters import HTTPAdapter
+import lxml.etree
 import os
+import copy
+import hashlib
+import json
+import random
+import sys
+from collections import OrderedDict, deque
+import functools
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+try:
+    from streamlit.runtime.scriptrunner_utils.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+except ImportError:  # streamlit < 1.38
+    from streamlit.runtime.scriptrunner.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
 
 # ==================== 核心初始化 ====================
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -25,6 +37,7 @@ ADSENSE_PUB_ID = 'ca-pub-4585150092118682'
 
 def inject_adsense_head():
     """全域注入 AdSense 腳本到 Header"""
+    import streamlit.components.v1 as components
     st.markdown(
         f'<script async src="https://pagead2.googlesyndication.com/pagead/js/adsbygoogle.js?client={ADSENSE_PUB_ID}" crossorigin="anonymous"></script>', 
         unsafe_allow_html=True
@@ -81,6 +94,7 @@ OPENAI_KEY = os.environ.get("OPENAI_API_KEY", "")
 def get_gemini_model(api_key):
     if not api_key: 
         return None, "未設定"
+    import google.generativeai as genai
     genai.configure(api_key=api_key)
     try:
         available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
@@ -102,18 +116,114 @@ def get_gemini_model(api_key):
 def get_openai_client(api_key):
     if not api_key: 
         return None
+    from openai import OpenAI
     return OpenAI(api_key=api_key)
 
-gemini_model, gemini_name = get_gemini_model(GEMINI_KEY)
-openai_client = get_openai_client(OPENAI_KEY)
-MANUAL_SETTLEMENT_FIX = {'202501W1': '2025/01/02'}
+OPENAI_MODEL = "gpt-4o-mini"
+AI_CACHE_TTL = 1800
+AI_CACHE_MAX_ENTRIES = 256
+AI_SPOT_BUCKET = 10
+AI_CLIENT_REFRESH_SECONDS = 6 * 3600
+AI_HEDGE_POLL_SECONDS = 3
+AI_PROVIDER_LABELS = {'gemini': 'GEMINI', 'chatgpt': 'CHATGPT', 'hedged': '雙引擎'}
+
+class AIClientRegistry:
+    """AI 用戶端整個程序只建立一次: 首次使用時解析 (list_models 需網路), 之後定期在背景更新"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gemini = (None, "未設定")
+        self.openai = None
+        self.resolved_at = None
+        self.pending = None
+
+    def resolve(self):
+        try:
+            gemini = get_gemini_model(GEMINI_KEY)
+            openai = get_openai_client(OPENAI_KEY)
+            with self.lock:
+                self.gemini, self.openai = gemini, openai
+                self.resolved_at = time.time()
+        finally:
+            with self.lock:
+                self.pending = None
+
+    def prefetch(self):
+        """未解析或已過期時在背景解析, 不阻塞呼叫者"""
+        with self.lock:
+            stale = self.resolved_at is None or time.time() - self.resolved_at > AI_CLIENT_REFRESH_SECONDS
+            if stale and self.pending is None:
+                self.pending = get_executor('ai-init', 1).submit(self.resolve)
+            return self.pending
+
+    def ensure(self):
+        """確保至少解析過一次 (首次使用時等待), 之後的更新都在背景進行"""
+        pending = self.prefetch()
+        if self.resolved_at is None and pending is not None:
+            pending.result()
+        return self
+
+@st.cache_resource
+def get_ai_clients():
+    return AIClientRegistry()
+
+def get_gemini():
+    """回傳 (Gemini 模型, 模型名稱)"""
+    return get_ai_clients().ensure().gemini
+
+def get_openai():
+    return get_ai_clients().ensure().openai
+
+def ai_client_badge(model_ready, api_key):
+    """側邊欄狀態: 只讀取已快取的狀態, 不觸發網路請求"""
+    if get_ai_clients().resolved_at is None:
+        return '⏳' if api_key else '❌'
+    return '✅' if model_ready else '❌'
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+HOLIDAY_FILE = os.environ.get("TW_HOLIDAY_FILE", os.path.join(APP_DIR, "tw_holidays.csv"))
+HISTORY_DB = os.environ.get("TAIFEX_HISTORY_DB", os.path.join(APP_DIR, "taifex_history.sqlite3"))
+
+# ==================== 交易日曆 ====================
+TAIFEX_PUBLISH_HOUR = 15
+
+@st.cache_resource
+def load_market_holidays(path=HOLIDAY_FILE):
+    """載入休市日表 (CSV: date,name), 讀取失敗則只套用週末規則"""
+    try:
+        df = pd.read_csv(path, comment='#', dtype=str)
+        return frozenset(pd.to_datetime(df['date'].str.strip(), format='%Y/%m/%d').dt.date)
+    except Exception:
+        return frozenset()
+
+def is_trading_day(day):
+    return day.weekday() < 5 and day not in load_market_holidays()
+
+def next_trading_day(day):
+    """day 本身或之後第一個交易日"""
+    while not is_trading_day(day):
+        day += timedelta(days=1)
+    return day
+
+def latest_published_trading_date():
+    """期交所盤後報表應已公布的最近交易日 (YYYY/MM/DD)"""
+    now = datetime.now(tz=TW_TZ)
+    day = now.date()
+    if now.hour < TAIFEX_PUBLISH_HOUR or not is_trading_day(day):
+        day -= timedelta(days=1)
+        while not is_trading_day(day):
+            day -= timedelta(days=1)
+    return day.strftime('%Y/%m/%d')
+
+def candidate_query_dates(max_days):
+    """由今天往回 max_days 個日曆日內的交易日 (YYYY/MM/DD), 跳過週末與休市日"""
+    today = datetime.now(tz=TW_TZ).date()
+    days = (today - timedelta(days=i) for i in range(max_days))
+    return [d.strftime('%Y/%m/%d') for d in days if is_trading_day(d)]
 
 # ==================== 核心日期函式 ====================
 def get_settlement_date(contract_code):
+    """合約結算日, 遇休市順延至下一交易日"""
     code = str(contract_code).strip().upper()
-    for key, fix_date in MANUAL_SETTLEMENT_FIX.items():
-        if key in code: 
-            return fix_date
     try:
         if len(code) < 6: 
             return "9999/99/99"
@@ -133,20 +243,1013 @@ def get_settlement_date(contract_code):
         else:
             if len(wednesdays) >= 3: 
                 day = wednesdays[2]
-        return f"{year}/{month:02d}/{day:02d}" if day else "9999/99/99"
+        if not day:
+            return "9999/99/99"
+        return next_trading_day(datetime(year, month, day).date()).strftime('%Y/%m/%d')
     except: 
         return "9999/99/99"
 
-# ==================== 數據抓取函式 ====================
+def get_time_to_expiry(settlement_date):
+    """距結算日年化時間 (最少 0.001 年)"""
+    today = datetime.now(tz=TW_TZ)
+    expiry = datetime.strptime(settlement_date, '%Y/%m/%d').replace(tzinfo=TW_TZ)
+    return max((expiry - today).days / 365.0, 0.001)
+
+# ==================== HTTP 用戶端 ====================
+HTTP_POOL_HOSTS = 8
+HTTP_MAX_PER_HOST = 6
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_READ_TIMEOUT = 10
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.5
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+HTTP_REQUEST_BUDGET = 15  # 單一日期請求 (含重試) 的時間上限
+HTTP_QUOTE_BUDGET = 4     # 即時報價請求的時間上限
+FETCH_DEADLINES = {'futures_contracts': 20, 'institutional_options': 20, 'option_chain': 45}
+
+class UpstreamError(Exception):
+    """上游連線失敗或逾時 (與「該日無資料」區分)"""
+
+class Deadline:
+    """一次抓取的總時間預算, 每個請求的 timeout 不超過剩餘時間"""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise UpstreamError("deadline exceeded")
+        return min(connect, remaining), min(read, remaining)
+
+@st.cache_resource
+def get_http_session():
+    """整個程序共用的連線池 (keep-alive, 每個主機最多 HTTP_MAX_PER_HOST 條連線)"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_MAX_PER_HOST, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = 'Mozilla/5.0'
+    return session
+
+def http_request(method, url, deadline=None, retries=HTTP_RETRIES, **kwargs):
+    """經共用連線池發出請求; 連線錯誤、逾時與 5xx/429 以 jitter 指數退避重試, 總時間不超過 deadline
+
+    重試用盡或時間不足時拋出 UpstreamError; 其他 4xx 直接拋出 requests.HTTPError。
+    """
+    deadline = deadline or Deadline(HTTP_REQUEST_BUDGET)
+    kwargs.setdefault('verify', False)
+    for attempt in range(retries + 1):
+        try:
+            res = get_http_session().request(method, url, timeout=deadline.timeout(), **kwargs)
+            if res.status_code not in HTTP_RETRY_STATUS:
+                res.raise_for_status()
+                return res
+            error = UpstreamError(f"HTTP {res.status_code}: {url}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = UpstreamError(f"{type(e).__name__}: {url}")
+        delay = HTTP_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if attempt == retries or deadline.remaining() <= delay:
+            raise error
+        time.sleep(delay)
+
+# ==================== 併發抓取 ====================
+PROBE_BATCH_SIZE = 5
+
+@st.cache_resource
+def get_executor(name, max_workers):
+    """整個程序共用的執行緒池 (Streamlit 每次 rerun 不會重建)"""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+def submit_task(executor, fn, *args, **kwargs):
+    """提交工作並沿用目前 session 的 ScriptRunContext (讓 st.cache_data 在背景執行緒正常運作)
+
+    執行緒池會重複使用工作執行緒, 完成後還原該執行緒原本的 context, 避免之後不帶 context 的
+    工作 (背景更新、API、盤中輪詢) 沿用上一個 session 的 context。
+    """
+    ctx = get_script_run_ctx()
+    def run():
+        thread = threading.current_thread()
+        previous = get_script_run_ctx(suppress_warning=True)
+        # 直接設定屬性: add_script_run_ctx 遇到 None 不會清除
+        setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, ctx)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, previous)
+    return executor.submit(run)
+
+def probe_recent_dates(fetch_one, query_dates, need=1, batch_size=PROBE_BATCH_SIZE, known=None, deadline=None):
+    """分批平行探測候選日期, 回傳找到的 [(date, result), ...] (由新到舊, 找滿 need 個即停止, 最後一批可能多於 need)
+
+    候選日期已排除週末與休市日, 幾乎每天都有資料: 第一批只探測還缺的 need 個日期,
+    出現無資料或失敗後才放寬到 batch_size 個一批。
+    known 為已取得的 {date: result} (例如歷史庫), 這些日期直接採用不再發出請求。
+    fetch_one 回傳 None 表示該日無資料; 拋出例外視為連線失敗。到 deadline 仍未完成的日期不再等待,
+    若一筆都沒取得且曾發生連線失敗 (或逾時), 拋出 UpstreamError 而非當作無資料。端點斷路時不再探測下一批。
+    """
+    executor = get_executor('probe', 16)
+    known = known or {}
+    found = []
+    failures = 0
+    circuit_open = False
+    start = 0
+    while start < len(query_dates):
+        missing = need - len(found)
+        size = missing if start == 0 or len(found) == start else max(missing, batch_size)
+        batch = query_dates[start:start + size]
+        start += size
+        futures = [None if d in known else submit_task(executor, fetch_one, d) for d in batch]
+        for query_date, future in zip(batch, futures):
+            try:
+                result = known[query_date] if future is None else future.result(timeout=deadline.remaining() if deadline else None)
+            except Exception as e:
+                failures += 1
+                circuit_open = circuit_open or isinstance(e, CircuitOpenError)
+                result = None
+            if result is not None:
+                found.append((query_date, result))
+        if len(found) >= need or circuit_open or (deadline and deadline.expired()):
+            break
+    if not found and failures:
+        raise UpstreamError(f"{getattr(fetch_one, '__name__', 'fetch')}: {failures} 個日期連線失敗或逾時")
+    return found
+
+def fetch_market_snapshot():
+    """平行抓取現貨、期貨與法人籌碼, 耗時約等於最慢的單一來源"""
+    executor = get_executor('source', 4)
+    futures = {
+        'taiex': submit_task(executor, lambda: (get_live_spot(), 0)),
+        'fut_contracts': submit_task(executor, get_futures_contracts_snapshot.get_with_age),
+        'inst_opt': submit_task(executor, get_institutional_option_data.get_with_age),
+    }
+    results, ages = {}, [0]
+    for key, future in futures.items():
+        try:
+            results[key], age = future.result()
+            ages.append(age)
+        except Exception:
+            results[key] = None
+    return {
+        'taiex': results['taiex'],
+        'futures': futures_data_from_snapshot(results['fut_contracts']),
+        'inst_fut': institutional_futures_from_snapshot(results['fut_contracts']),
+        'inst_opt': results['inst_opt'],
+        'age': max(ages),
+    }
+
+# ==================== 共用快取工具 ====================
+class TTLCache:
+    """執行緒安全、有 TTL 與筆數上限 (LRU 淘汰) 的記憶體快取"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+def bucket_spot(spot_price, bucket):
+    """現貨取整至 bucket 點 (快取 key 用), 無現貨回傳 None"""
+    return int(round(spot_price / bucket) * bucket) if spot_price else None
+
+def fingerprint(*parts):
+    """將正規化後的輸入轉為穩定的雜湊字串"""
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+# ==================== 請求合併 (single-flight) ====================
+class SingleFlight:
+    """同一 key 同時只發出一次請求, 其餘呼叫者等待並共用同一結果"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.stats = {}
+
+    def do(self, name, key, fn):
+        with self.lock:
+            stat = self.stats.setdefault(name, {'calls': 0, 'executions': 0, 'coalesced': 0})
+            stat['calls'] += 1
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self.inflight[key] = call
+                stat['executions'] += 1
+            else:
+                stat['coalesced'] += 1
+        if leader:
+            try:
+                call['result'] = fn()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+                call['event'].set()
+        else:
+            call['event'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(stat) for name, stat in self.stats.items()}
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+def single_flight(name):
+    """以 (name, 參數) 為 key 合併同時進行的相同請求"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (name, args, tuple(sorted(kwargs.items())))
+            return get_single_flight().do(name, key, lambda: fn(*args, **kwargs))
+        return wrapper
+    return decorator
+
+def single_flight_stats():
+    """各端點請求合併統計 (呼叫數 / 實際請求數 / 被合併數)"""
+    stats = get_single_flight().snapshot()
+    return pd.DataFrame(
+        [{'來源': name, '呼叫': v['calls'], '實際請求': v['executions'], '合併': v['coalesced']} for name, v in stats.items()]
+    )
+
+# ==================== 上游健康 (無資料快取 / 斷路器) ====================
+NO_DATA_TTL_PAST = 6 * 3600  # 已過去的日期查無資料 (休市或未開盤), 短期內不會改變
+NO_DATA_TTL_TODAY = 120      # 今日報表可能稍後才公布
+NO_DATA_MAX_ENTRIES = 512
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_SECONDS = 60
+
+class CircuitOpenError(UpstreamError):
+    """端點斷路中, 未發出請求即失敗"""
+
+class NoDataCache:
+    """(端點, 日期) → 查無資料; 過去的日期記得久, 今天只記得短時間"""
+
+    def __init__(self, max_entries=NO_DATA_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+
+    def ttl(self, query_date):
+        today = datetime.now(tz=TW_TZ).strftime('%Y/%m/%d')
+        return NO_DATA_TTL_TODAY if query_date >= today else NO_DATA_TTL_PAST
+
+    def contains(self, endpoint, query_date):
+        key = (endpoint, query_date)
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if time.time() >= expires:
+                del self.entries[key]
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, endpoint, query_date):
+        with self.lock:
+            self.entries[(endpoint, query_date)] = time.time() + self.ttl(query_date)
+            self.entries.move_to_end((endpoint, query_date))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def count(self, endpoint):
+        now = time.time()
+        with self.lock:
+            return sum(1 for (name, _), expires in self.entries.items() if name == endpoint and expires > now)
+
+class CircuitBreaker:
+    """連續失敗 BREAKER_FAILURE_THRESHOLD 次後斷路; 斷路期間直接失敗, 到期後放行一次試探請求"""
+
+    def __init__(self, name, threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.time() - self.opened_at < self.reset_seconds:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} 斷路中")
+            self.probing = True
+
+    def record(self, ok):
+        with self.lock:
+            self.probing = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.probing or time.time() - self.opened_at >= self.reset_seconds else 'open'
+
+class UpstreamHealth:
+    """整個程序共用的無資料快取與各端點斷路器"""
+
+    def __init__(self):
+        self.no_data = NoDataCache()
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def breaker(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(endpoint)
+            return self.breakers[endpoint]
+
+@st.cache_resource
+def get_upstream_health():
+    return UpstreamHealth()
+
+def upstream_endpoint(name):
+    """單日抓取函式的外層: 已知查無資料的日期直接回傳 None, 端點斷路時不發出請求
+
+    只有 UpstreamError / requests 例外計為端點失敗; 回傳 None (查無資料) 或解析錯誤代表上游有回應。
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(query_date):
+            health = get_upstream_health()
+            if health.no_data.contains(name, query_date):
+                return None
+            breaker = health.breaker(name)
+            breaker.before_call()
+            ok = True
+            try:
+                result = fn(query_date)
+            except (UpstreamError, requests.RequestException):
+                ok = False
+                raise
+            finally:
+                breaker.record(ok)
+            if result is None:
+                health.no_data.add(name, query_date)
+            return result
+        return wrapper
+    return decorator
+
+def upstream_status():
+    """各端點斷路狀態與已知無資料日期數"""
+    health = get_upstream_health()
+    with health.lock:
+        breakers = list(health.breakers.values())
+    return pd.DataFrame([
+        {'端點': b.name, '狀態': b.state(), '連續失敗': b.failures, '拒絕': b.rejected, '無資料日期': health.no_data.count(b.name)}
+        for b in breakers
+    ])
+
+# ==================== 背景更新快取 (stale-while-revalidate) ====================
+SWR_REFRESH_RATIO = 0.8
+SWR_POLL_SECONDS = 15
+SWR_IDLE_TTLS = 3
+SWR_MAX_ENTRIES = 32
+REFRESH_COOLDOWN = 60
+REFRESH_WAIT_SECONDS = 20
+
+class StaleWhileRevalidateCache:
+    """到期前由背景執行緒更新; 更新期間讀取者直接拿到上一份成功的資料與其資料年齡"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.thread = threading.Thread(target=self.run, name='swr-refresher', daemon=True)
+        self.thread.start()
+
+    def get(self, name, fn, args, kwargs, ttl, data_date=None):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['last_access'] = now
+                age = now - entry['fetched_at']
+                if age >= ttl * SWR_REFRESH_RATIO:
+                    self.schedule(key, entry)
+                return entry['value'], age
+
+        value = get_single_flight().do(name, key, lambda: fn(*args, **kwargs))
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = {
+                    'name': name, 'fn': fn, 'args': args, 'kwargs': kwargs, 'ttl': ttl, 'data_date': data_date,
+                    'value': value, 'fetched_at': time.time(), 'last_access': now, 'refreshing': None,
+                }
+                self.evict()
+            return self.entries[key]['value'], time.time() - self.entries[key]['fetched_at']
+
+    def schedule(self, key, entry):
+        """呼叫時需持有 self.lock, 回傳進行中的更新工作"""
+        if entry['refreshing'] is None:
+            entry['refreshing'] = get_executor('refresh', 2).submit(self.refresh, key, entry)
+        return entry['refreshing']
+
+    def refresh(self, key, entry):
+        try:
+            value = get_single_flight().do(entry['name'], key, lambda: entry['fn'](*entry['args'], **entry['kwargs']))
+        except Exception:
+            value = None
+        with self.lock:
+            entry['refreshing'] = None
+            # 更新失敗時保留上一份成功的資料
+            if value is not None or entry['value'] is None:
+                entry['value'] = value
+                entry['fetched_at'] = time.time()
+
+    def evict(self):
+        """呼叫時需持有 self.lock; 超過上限時淘汰最久未讀取的項目"""
+        while len(self.entries) > SWR_MAX_ENTRIES:
+            oldest = min(self.entries, key=lambda k: self.entries[k]['last_access'])
+            del self.entries[oldest]
+
+    def run(self):
+        while True:
+            time.sleep(SWR_POLL_SECONDS)
+            try:
+                now = time.time()
+                with self.lock:
+                    for key, entry in list(self.entries.items()):
+                        if now - entry['last_access'] > entry['ttl'] * SWR_IDLE_TTLS:
+                            del self.entries[key]
+                        elif now - entry['fetched_at'] >= entry['ttl'] * SWR_REFRESH_RATIO:
+                            self.schedule(key, entry)
+            except Exception:
+                pass
+
+    def invalidate(self, latest_date):
+        """只更新資料日期早於 latest_date (上游可能已有新資料) 的項目, 回傳 {名稱: 更新工作}"""
+        pending = {}
+        with self.lock:
+            for key, entry in self.entries.items():
+                try:
+                    current = entry['data_date'](entry['value']) if entry['data_date'] else None
+                except Exception:
+                    current = None
+                if current is not None and current >= latest_date:
+                    continue
+                pending[entry['name']] = self.schedule(key, entry)
+        return pending
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            return [
+                {'name': e['name'], 'age': now - e['fetched_at'], 'ttl': e['ttl'], 'refreshing': e['refreshing'] is not None}
+                for e in self.entries.values()
+            ]
+
+@st.cache_resource
+def get_swr_cache():
+    return StaleWhileRevalidateCache()
+
+def stale_while_revalidate(name, ttl, data_date=None):
+    """取代 st.cache_data(ttl=...): 資料由背景更新, 讀取者不需等待過期重抓
+
+    wrapper(*args) 回傳資料副本; wrapper.get_with_age(*args) 另回傳資料年齡 (秒)。
+    data_date(value) 回傳資料所屬交易日, 供重新整理時判斷上游是否可能已更新。
+    """
+    def decorator(fn):
+        def get_with_age(*args, **kwargs):
+            value, age = get_swr_cache().get(name, fn, args, kwargs, ttl, data_date)
+            return copy.deepcopy(value), age
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return get_with_age(*args, **kwargs)[0]
+
+        wrapper.get_with_age = get_with_age
+        return wrapper
+    return decorator
+
+def refresh_stale_datasets(timeout=REFRESH_WAIT_SECONDS):
+    """使用者手動重新整理: 只重抓上游可能已有新資料的資料集, 其他 session 期間仍讀取舊資料"""
+    pending = get_swr_cache().invalidate(latest_published_trading_date())
+    if pending:
+        wait(list(pending.values()), timeout=timeout)
+    return sorted(pending)
+
+def cache_status():
+    """背景更新快取狀態 (資料集 / 資料年齡 / 是否更新中)"""
+    return pd.DataFrame([
+        {'資料集': s['name'], '資料年齡(秒)': int(s['age']), 'TTL': s['ttl'], '更新中': '🔄' if s['refreshing'] else ''}
+        for s in get_swr_cache().status()
+    ])
+
+# ==================== 歷史資料庫 ====================
+HISTORY_COLUMNS = ['Month', 'Strike', 'Type', 'OI', 'Price']
+
+@st.cache_resource
+def get_history_lock():
+    """整個程序共用的寫入鎖 (模組層級的鎖會在每次 rerun 重建)"""
+    return threading.Lock()
+
+def open_history_db(path=HISTORY_DB):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS option_chain ("
+        "commodity TEXT NOT NULL, trade_date TEXT NOT NULL, "
+        "Month TEXT, Strike REAL, Type TEXT, OI REAL, Price REAL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_option_chain_date ON option_chain (commodity, trade_date)")
+    return conn
+
+def load_option_history(commodity, query_dates):
+    """讀取已入庫的每日報價鏈, 回傳 {date: df}; 資料庫不可用時回傳空 dict"""
+    if not query_dates:
+        return {}
+    try:
+        with get_history_lock():
+            conn = open_history_db()
+            try:
+                placeholders = ",".join("?" * len(query_dates))
+                rows = pd.read_sql_query(
+                    f"SELECT trade_date, {', '.join(HISTORY_COLUMNS)} FROM option_chain "
+                    f"WHERE commodity = ? AND trade_date IN ({placeholders})",
+                    conn, params=[commodity, *query_dates]
+                )
+            finally:
+                conn.close()
+    except Exception:
+        return {}
+    history = {}
+    for query_date, df in rows.groupby('trade_date'):
+        df_clean = df[HISTORY_COLUMNS].reset_index(drop=True)
+        df_clean['Amount'] = df_clean['OI'] * df_clean['Price'] * 50
+        history[query_date] = df_clean
+    return history
+
+def save_option_history(commodity, query_date, df_clean):
+    """寫入單日報價鏈 (已公布的日報不再變動, 同日重寫以覆蓋)"""
+    try:
+        rows = df_clean[HISTORY_COLUMNS].copy()
+        rows.insert(0, 'trade_date', query_date)
+        rows.insert(0, 'commodity', commodity)
+        with get_history_lock():
+            conn = open_history_db()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM option_chain WHERE commodity = ? AND trade_date = ?", (commodity, query_date))
+                    rows.to_sql('option_chain', conn, if_exists='append', index=False)
+            finally:
+                conn.close()
+    except Exception:
+        pass
+
+# ==================== 報表解析 ====================
+# 目標表格解析器只以合成頁面核對過; 以 benchmarks.py --capture 存下的實際頁面核對通過前, 正式路徑維持 read_html
+TARGETED_PARSERS = os.environ.get("TARGETED_PARSERS", "") == "1"
+
+def parse_report(targeted, read_html, html):
+    """TARGETED_PARSERS 開啟時先用目標表格解析器 (找不到表格再退回 read_html), 否則只用 read_html"""
+    if TARGETED_PARSERS:
+        result = targeted(html)
+        if result is not None:
+            return result
+    return read_html(html)
+
+def extract_table_grid(html, keyword=None):
+    """只切出第一個包含 keyword 的 <table> (未指定則取第一個表格) 並展開 rowspan/colspan
+
+    回傳 (header_rows, body_rows), 每列為字串 list; 找不到表格回傳 None。
+    表頭為開頭全是 <th> 的列; 表頭改用 <td> 時, 改以開頭不含任何數字的列為表頭。
+    """
+    if keyword is None:
+        start = html.find('<table')
+        end = html.find('</table>', start)
+        if start == -1 or end == -1:
+            return None
+    else:
+        pos = html.find(keyword)
+        while pos != -1:
+            start = html.rfind('<table', 0, pos)
+            end = html.find('</table>', pos)
+            if start != -1 and end != -1 and html.find('</table>', start, pos) == -1:
+                break
+            pos = html.find(keyword, pos + len(keyword))
+        if pos == -1:
+            return None
+
+    table = lxml.etree.HTML(html[start:end + len('</table>')])
+    grid, header_rows, pending = [], 0, {}
+    for tr in table.iter('tr'):
+        cells = [c for c in tr if c.tag in ('td', 'th')]
+        if not cells:
+            continue
+        texts = [(c.text or "").strip() if len(c) == 0 else " ".join("".join(c.itertext()).split()) for c in cells]
+        if not pending and not any(c.attrib for c in cells):
+            row = texts
+        else:
+            row, col = [], 0
+            for cell, text in zip(cells, texts):
+                col = fill_pending_cells(row, col, pending)
+                colspan = int(cell.get('colspan', 1) or 1)
+                rowspan = int(cell.get('rowspan', 1) or 1)
+                for _ in range(colspan):
+                    row.append(text)
+                    if rowspan > 1:
+                        pending[col] = (text, rowspan - 1)
+                    col += 1
+            fill_pending_cells(row, col, pending)
+        if len(grid) == header_rows and all(c.tag == 'th' for c in cells):
+            header_rows += 1
+        grid.append(row)
+
+    if header_rows == 0:
+        while header_rows < len(grid) and not any(ch.isdigit() for cell in grid[header_rows] for ch in cell):
+            header_rows += 1
+    width = max((len(r) for r in grid), default=0)
+    grid = [r + [''] * (width - len(r)) for r in grid]
+    return grid[:header_rows], grid[header_rows:]
+
+def fill_pending_cells(row, col, pending):
+    """補上由上方 rowspan 延伸到本列的儲存格, 回傳下一個欄位位置"""
+    while col in pending:
+        text, left = pending[col]
+        row.append(text)
+        if left > 1:
+            pending[col] = (text, left - 1)
+        else:
+            del pending[col]
+        col += 1
+    return col
+
+def header_columns(header, *keywords):
+    """多層表頭合併後同時包含所有 keywords 的欄位位置 list"""
+    width = len(header[0]) if header else 0
+    return [i for i in range(width) if all(k in " ".join(h[i] for h in header) for k in keywords)]
+
+def net_oi_column(header, default):
+    """法人表「未平倉」區塊最後一個「口數」欄 (多空 / 買賣淨額), 表頭無法辨識時用 default"""
+    columns = header_columns(header, '未平倉', '口數')
+    return columns[-1] if columns else default
+
+def to_number(values):
+    """去除千分位後轉數值, 無法轉換者為 NaN"""
+    return pd.to_numeric(pd.Series([str(v).replace(',', '') for v in values], dtype=object), errors='coerce')
+
+def map_option_columns(columns):
+    """optDailyMarketReport 欄位名稱對應, 回傳 {欄位: 位置}"""
+    col_map = {}
+    for i, col in enumerate(columns):
+        col_str = str(col).strip()
+        
+        if '未沖銷' in col_str and '契約量' in col_str:
+            col_map['OI'] = i
+        elif '到期月份' in col_str or '週別' in col_str:
+            col_map['Month'] = i
+        elif col_str == '契約' and 'Month' not in col_map:
+            col_map['Month'] = i
+        elif '履約價' in col_str:
+            col_map['Strike'] = i
+        elif '買賣權' in col_str:
+            col_map['Type'] = i
+        elif '結算價' in col_str:
+            col_map['Price'] = i
+        elif '收盤價' in col_str and 'Price' not in col_map:
+            col_map['Price'] = i
+    return col_map
+
+def parse_option_daily_report(html):
+    """optDailyMarketReport → Month/Strike/Type/OI/Price/Amount (數值欄位已轉型)"""
+    table = extract_table_grid(html, '履約價')
+    if table is None:
+        return None
+    header, body = table
+    if not header or not body:
+        return None
+    columns = [" ".join(dict.fromkeys(h[i] for h in header if h[i])) for i in range(len(header[0]))]
+    idx = map_option_columns(columns)
+    
+    required = ['Month', 'Strike', 'Type', 'OI', 'Price']
+    if not all(k in idx for k in required):
+        return None
+    rows = [r for r in body if r[idx['Type']]]
+    
+    price = to_number(r[idx['Price']] for r in rows).fillna(0)
+    oi = to_number(r[idx['OI']] for r in rows).fillna(0)
+    return pd.DataFrame({
+        'Month': [r[idx['Month']] for r in rows],
+        'Strike': to_number(r[idx['Strike']] for r in rows),
+        'Type': [r[idx['Type']] for r in rows],
+        'OI': oi,
+        'Price': price,
+        'Amount': oi * price * 50
+    })
+
+def read_first_table(html):
+    """pd.read_html 的第一個表格, 頁面沒有表格回傳 None"""
+    try:
+        dfs = pd.read_html(StringIO(html))
+    except ValueError:
+        return None
+    return dfs[0] if dfs else None
+
+def parse_option_daily_report_read_html(html):
+    """舊版 pd.read_html 解析 (目前的正式路徑, 並作為基準測試對照)"""
+    df = read_first_table(html)
+    if df is None: 
+        return None
+    
+    # 精確欄位對應
+    col_map = map_option_columns(df.columns)
+    
+    required = ['Month', 'Strike', 'Type', 'OI', 'Price']
+    if not all(k in col_map for k in required):
+        return None
+    
+    df_clean = df.iloc[:, [col_map[k] for k in required]].copy()
+    df_clean.columns = required
+    df_clean = df_clean.dropna(subset=['Type'])
+    
+    df_clean['Month'] = df_clean['Month'].astype(str).str.strip()
+    df_clean['Type'] = df_clean['Type'].astype(str).str.strip()
+    df_clean['Strike'] = pd.to_numeric(df_clean['Strike'].astype(str).str.replace(',', ''), errors='coerce')
+    df_clean['OI'] = pd.to_numeric(df_clean['OI'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
+    df_clean['Price'] = pd.to_numeric(df_clean['Price'].astype(str).str.replace(',', '').replace('-', '0'), errors='coerce').fillna(0)
+    df_clean['Amount'] = df_clean['OI'] * df_clean['Price'] * 50
+    return df_clean
+
+def parse_futures_price(html):
+    """futContractsDate 第一個表格中收盤價/成交價欄的第一列, 找不到此欄回傳 None
+
+    queryType=1 (行情表) 必定有此欄; 快照會先試著從 queryType=2 (法人表) 解析, 找不到才改抓 queryType=1。
+    """
+    table = extract_table_grid(html)
+    if table is None or not table[0] or not table[1]:
+        return None
+    header, body = table
+    for i in range(len(header[0])):
+        col_str = " ".join(h[i] for h in header)
+        if '收盤價' in col_str or '成交價' in col_str:
+            value = to_number([body[0][i]]).iloc[0]
+            if value > 0:
+                return float(value)
+    return None
+
+def parse_institutional_futures(html):
+    """futContractsDate (queryType=2) 臺股期貨三大法人淨部位 {法人: 口數}"""
+    table = extract_table_grid(html, '臺股期貨')
+    if table is None:
+        return None
+    net_col = net_oi_column(table[0], 13)
+    inst_data = {}
+    for row in table[1]:
+        row_str = " ".join(row)
+        if '臺股期貨' not in row_str or len(row) <= net_col:
+            continue
+        net_position = to_number([row[net_col]]).iloc[0]
+        if pd.isna(net_position):
+            continue
+        if '外資' in row_str:
+            inst_data['外資'] = int(net_position)
+        elif '投信' in row_str:
+            inst_data['投信'] = int(net_position)
+        elif '自營商' in row_str:
+            inst_data['自營商'] = int(net_position)
+    return inst_data
+
+def parse_institutional_options(html):
+    """callsAndPutsDate 臺指選擇權法人淨未平倉 {法人: {'Call': n, 'Put': n}}"""
+    table = extract_table_grid(html, '臺指選擇權')
+    if table is None:
+        return None
+    net_col = net_oi_column(table[0], 14)
+    inst_data = {}
+    for row in table[1]:
+        if '臺指選擇權' not in " ".join(row) or len(row) <= net_col:
+            continue
+        net_oi = to_number([row[net_col]]).iloc[0]
+        if pd.isna(net_oi):
+            continue
+        option_type, institution = row[2], row[3]
+        if '買權' in option_type:
+            inst_data.setdefault(institution, {})['Call'] = int(net_oi)
+        elif '賣權' in option_type:
+            inst_data.setdefault(institution, {})['Put'] = int(net_oi)
+    return inst_data
+
+def parse_futures_price_read_html(html):
+    """舊版 get_futures_data 的 read_html 解析: 第一個表格收盤價/成交價欄第一列"""
+    df = read_first_table(html)
+    if df is None or df.empty:
+        return None
+    for col in df.columns:
+        if '收盤價' in str(col) or '成交價' in str(col):
+            value = pd.to_numeric(str(df.iloc[0][col]).replace(',', ''), errors='coerce')
+            if value > 0:
+                return float(value)
+    return None
+
+def parse_institutional_futures_read_html(html):
+    """舊版 get_institutional_futures_position 的 read_html 解析 (淨部位為第 14 欄)"""
+    df = read_first_table(html)
+    if df is None:
+        return None
+    inst_data = {}
+    for row in df.itertuples(index=False):
+        row_str = " ".join(str(x) for x in row)
+        if '臺股期貨' not in row_str or len(row) <= 13:
+            continue
+        net_position = to_number([row[13]]).iloc[0]
+        if pd.isna(net_position):
+            continue
+        if '外資' in row_str:
+            inst_data['外資'] = int(net_position)
+        elif '投信' in row_str:
+            inst_data['投信'] = int(net_position)
+        elif '自營商' in row_str:
+            inst_data['自營商'] = int(net_position)
+    return inst_data
+
+def parse_institutional_options_read_html(html):
+    """舊版 get_institutional_option_data 的 read_html 解析 (權別 / 身份別 / 淨未平倉為第 3 / 4 / 15 欄)"""
+    df = read_first_table(html)
+    if df is None:
+        return None
+    inst_data = {}
+    for row in df.itertuples(index=False):
+        if '臺指選擇權' not in " ".join(str(x) for x in row) or len(row) <= 14:
+            continue
+        net_oi = to_number([row[14]]).iloc[0]
+        if pd.isna(net_oi):
+            continue
+        option_type, institution = str(row[2]), str(row[3])
+        if '買權' in option_type:
+            inst_data.setdefault(institution, {})['Call'] = int(net_oi)
+        elif '賣權' in option_type:
+            inst_data.setdefault(institution, {})['Put'] = int(net_oi)
+    return inst_data
+
+# ==================== 報價鏈格式 ====================
+def normalize_option_chain(df):
+    """入快取前統一為精簡格式, 下游一律以 is_call 判斷買賣權
+
+    Month / Settlement / Type 為 category, Strike 為 int32, is_call 為 bool,
+    OI 為 int64, Price 為 float32, Amount 為 float64 (以原始價格計算)。
+    """
+    df = df.dropna(subset=['Strike'])
+    month = df['Month'].astype(str).str.strip()
+    is_call = is_call_type(df['Type'])
+    settlement = {code: get_settlement_date(code) for code in month.unique()}
+    return pd.DataFrame({
+        'Month': month.astype('category'),
+        'Settlement': month.map(settlement).astype('category'),
+        'Strike': df['Strike'].round().astype('int32'),
+        'Type': pd.Categorical(np.where(is_call, '買權', '賣權')),
+        'is_call': is_call,
+        'OI': df['OI'].round().astype('int64'),
+        'Price': df['Price'].astype('float32'),
+        'Amount': df['Amount'].astype('float64'),
+    }).reset_index(drop=True)
+
+# ==================== 數據抓取函式 (單日) ====================
+@single_flight('futContractsDate')
+@upstream_endpoint('futContractsDate')
+def fetch_futures_contracts(query_date):
+    """單日 futContractsDate (TX) 快照: 法人淨部位來自 queryType=2, 資料不完整回傳 None
+
+    期貨價格只在同一份回應有收盤價/成交價欄時解析, 否則為 None, 由 get_futures_contracts_snapshot 補抓。
+    """
+    url = "https://www.taifex.com.tw/cht/3/futContractsDate"
+    payload = {
+        'queryType': '2',
+        'queryDate': query_date,
+        'commodity_id': 'TX'
+    }
+    
+    res = http_request('POST', url, data=payload)
+    res.encoding = 'utf-8'
+    
+    if "查無資料" in res.text or len(res.text) < 5000:
+        return None
+    
+    inst_data = parse_report(parse_institutional_futures, parse_institutional_futures_read_html, res.text)
+    if not inst_data or len(inst_data) != 3:
+        return None
+    futures_price = parse_report(parse_futures_price, parse_futures_price_read_html, res.text)
+    return {
+        'date': query_date,
+        'futures_price': futures_price,
+        'price_date': query_date if futures_price is not None else None,
+        'institutional': inst_data
+    }
+
+@single_flight('futContractsDate:price')
+@upstream_endpoint('futContractsDate:price')
+def fetch_futures_price(query_date):
+    """單日 futContractsDate (TX, queryType=1) 期貨收盤價, 無資料回傳 None"""
+    url = "https://www.taifex.com.tw/cht/3/futContractsDate"
+    payload = {'queryType': '1', 'marketCode': '0', 'commodity_id': 'TX', 'queryDate': query_date}
+    
+    res = http_request('POST', url, data=payload)
+    res.encoding = 'utf-8'
+    if "查無資料" in res.text:
+        return None
+    return parse_report(parse_futures_price, parse_futures_price_read_html, res.text)
+
+@single_flight('callsAndPutsDate')
+@upstream_endpoint('callsAndPutsDate')
+def fetch_institutional_options(query_date):
+    """單日法人選擇權淨未平倉, 資料不完整回傳 None"""
+    url = "https://www.taifex.com.tw/cht/3/callsAndPutsDate"
+    payload = {
+        'queryType': '2',
+        'queryDate': query_date,
+        'commodity_id': 'TXO'
+    }
+    
+    res = http_request('POST', url, data=payload)
+    res.encoding = 'utf-8'
+    
+    if "查無資料" in res.text or len(res.text) < 5000:
+        return None
+    
+    inst_data = parse_report(parse_institutional_options, parse_institutional_options_read_html, res.text)
+    if inst_data and any(len(v) == 2 for v in inst_data.values()):
+        inst_data['date'] = query_date
+        return inst_data
+    return None
+
+@single_flight('optDailyMarketReport')
+@upstream_endpoint('optDailyMarketReport')
+def fetch_option_chain(query_date):
+    """單日選擇權全市場報價鏈, 無資料回傳 None"""
+    url = "https://www.taifex.com.tw/cht/3/optDailyMarketReport"
+    payload = {
+        'queryType': '2', 
+        'marketCode': '0', 
+        'commodity_id': 'TXO', 
+        'queryDate': query_date, 
+        'MarketCode': '0', 
+        'commodity_idt': 'TXO'
+    }
+    
+    res = http_request('POST', url, data=payload)
+    res.encoding = 'utf-8'
+    if "查無資料" in res.text or len(res.text) < 500: 
+        return None
+    
+    df_clean = parse_report(parse_option_daily_report, parse_option_daily_report_read_html, res.text)
+    
+    if df_clean is not None and df_clean['OI'].sum() > 0 and len(df_clean) > 10:
+        return df_clean
+    return None
+
+# ==================== 數據抓取函式 (快取) ====================
 @st.cache_data(ttl=60)
 def get_realtime_data():
     """獲取大盤現貨即時價格"""
     taiex = None
     ts = int(time.time())
-    headers = {'User-Agent': 'Mozilla/5.0'}
     try:
         url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch=tse_t00.tw&json=1&delay=0&_={ts}000"
-        res = requests.get(url, timeout=2)
+        res = http_request('GET', url, deadline=Deadline(HTTP_QUOTE_BUDGET), retries=0, verify=True)
         data = res.json()
         if 'msgArray' in data and len(data['msgArray']) > 0:
             val = data['msgArray'][0].get('z', '-')
@@ -158,7 +1261,7 @@ def get_realtime_data():
     if taiex is None:
         try:
             url = f"https://query1.finance.yahoo.com/v8/finance/chart/%5ETWII?interval=1m&range=1d&_={ts}"
-            res = requests.get(url, headers=headers, timeout=3)
+            res = http_request('GET', url, deadline=Deadline(HTTP_QUOTE_BUDGET), retries=0, verify=True)
             data = res.json()
             price = data['chart']['result'][0]['meta'].get('regularMarketPrice')
             if price: taiex = float(price)
@@ -166,235 +1269,161 @@ def get_realtime_data():
             pass
     return taiex
 
-@st.cache_data(ttl=300)
-def get_futures_data():
-    """獲取台指期貨價格"""
-    url = "https://www.taifex.com.tw/cht/3/futContractsDate"
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    
-    for i in range(30):
-        target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
-        query_date = target_date.strftime('%Y/%m/%d')
-        payload = {'queryType': '1', 'marketCode': '0', 'commodity_id': 'TX', 'queryDate': query_date}
-        
+@stale_while_revalidate('futures_contracts', ttl=300, data_date=lambda v: v['date'] if v else None)
+def get_futures_contracts_snapshot():
+    """獲取 futContractsDate 快照 (期貨價格與法人期貨淨部位盡量共用同一次請求)
+
+    法人表沒有期貨價格時, 只對選定的快照日期補抓一次 queryType=1; 該日仍無價格才與改版前相同
+    往前 (30 日內) 找最近有價格的日期, 以 price_date 記錄。
+    """
+    query_dates = candidate_query_dates(30)
+    deadline = Deadline(FETCH_DEADLINES['futures_contracts'])
+    found = probe_recent_dates(fetch_futures_contracts, query_dates, deadline=deadline)
+    if not found:
+        return None
+    snapshot = found[0][1]
+    if snapshot['futures_price'] is None:
+        older = [d for d in query_dates if d <= snapshot['date']]
         try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
-            if "查無資料" in res.text: 
-                continue
-            
-            dfs = pd.read_html(StringIO(res.text))
-            if not dfs: 
-                continue
-            df = dfs[0]
-            
-            futures_price = None
-            for col in df.columns:
-                if '收盤價' in str(col) or '成交價' in str(col):
-                    try: 
-                        futures_price = float(str(df.iloc[0][col]).replace(',', ''))
-                        if futures_price > 0: 
-                            return futures_price, None, query_date
-                    except: 
-                        pass
-        except: 
-            pass
-    
+            prices = probe_recent_dates(fetch_futures_price, older, deadline=deadline)
+        except UpstreamError:
+            prices = []
+        if prices:
+            snapshot['price_date'], snapshot['futures_price'] = prices[0]
+    return snapshot
+
+def futures_data_from_snapshot(snapshot):
+    if snapshot and snapshot['futures_price']:
+        return snapshot['futures_price'], None, snapshot.get('price_date') or snapshot['date']
     return None, None, "N/A"
 
-@st.cache_data(ttl=300)
-def get_institutional_futures_position():
-    """獲取法人期貨淨部位"""
-    url = "https://www.taifex.com.tw/cht/3/futContractsDate"
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    
-    for i in range(10):
-        target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
-        query_date = target_date.strftime('%Y/%m/%d')
-        
-        payload = {
-            'queryType': '2',
-            'queryDate': query_date,
-            'commodity_id': 'TX'
-        }
-        
-        try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
-            
-            if "查無資料" in res.text or len(res.text) < 5000:
-                continue
-            
-            dfs = pd.read_html(StringIO(res.text))
-            if not dfs:
-                continue
-                
-            df = dfs[0]
-            inst_data = {}
-            
-            for idx, row in df.iterrows():
-                row_str = " ".join([str(x) for x in row.values])
-                
-                if '臺股期貨' not in row_str:
-                    continue
-                
-                try:
-                    net_position = int(str(row.iloc[13]).replace(',', ''))
-                except:
-                    continue
-                
-                if '外資' in row_str or '外資及陸資' in row_str:
-                    inst_data['外資'] = net_position
-                elif '投信' in row_str:
-                    inst_data['投信'] = net_position
-                elif '自營商' in row_str:
-                    inst_data['自營商'] = net_position
-            
-            if len(inst_data) == 3:
-                inst_data['date'] = query_date
-                return inst_data
-                
-        except Exception as e:
-            continue
-    
-    return None
+def institutional_futures_from_snapshot(snapshot):
+    if not snapshot:
+        return None
+    inst_data = dict(snapshot['institutional'])
+    inst_data['date'] = snapshot['date']
+    return inst_data
 
-@st.cache_data(ttl=300)
+@stale_while_revalidate('institutional_options', ttl=300, data_date=lambda v: v['date'] if v else None)
 def get_institutional_option_data():
     """獲取法人選擇權數據"""
-    url = "https://www.taifex.com.tw/cht/3/callsAndPutsDate"
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    
-    for i in range(10):
-        target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
-        query_date = target_date.strftime('%Y/%m/%d')
-        
-        payload = {
-            'queryType': '2',
-            'queryDate': query_date,
-            'commodity_id': 'TXO'
-        }
-        
-        try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
-            
-            if "查無資料" in res.text or len(res.text) < 5000:
-                continue
-            
-            dfs = pd.read_html(StringIO(res.text))
-            if not dfs:
-                continue
-            
-            df = dfs[0]
-            inst_data = {}
-            
-            for idx, row in df.iterrows():
-                row_str = " ".join([str(x) for x in row.values])
-                
-                if '臺指選擇權' not in row_str:
-                    continue
-                
-                try:
-                    option_type = str(row.iloc[2])
-                    institution = str(row.iloc[3])
-                    net_oi = int(str(row.iloc[14]).replace(',', ''))
-                    
-                    if institution not in inst_data:
-                        inst_data[institution] = {}
-                    
-                    if '買權' in option_type:
-                        inst_data[institution]['Call'] = net_oi
-                    elif '賣權' in option_type:
-                        inst_data[institution]['Put'] = net_oi
-                        
-                except:
-                    continue
-            
-            if inst_data and any(len(v) == 2 for v in inst_data.values()):
-                inst_data['date'] = query_date
-                return inst_data
-                
-        except Exception as e:
-            continue
-    
-    return None
+    found = probe_recent_dates(
+        fetch_institutional_options, candidate_query_dates(10), deadline=Deadline(FETCH_DEADLINES['institutional_options'])
+    )
+    return found[0][1] if found else None
 
-@st.cache_data(ttl=300)
+@stale_while_revalidate('option_chain', ttl=300, data_date=lambda v: v[0]['date'] if v else None)
 def get_option_data_multi_days(days=3):
-    """獲取選擇權全市場數據"""
-    url = "https://www.taifex.com.tw/cht/3/optDailyMarketReport"
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    all_data = []
-
-    for i in range(30):
-        target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
-        query_date = target_date.strftime('%Y/%m/%d')
-        payload = {
-            'queryType': '2', 
-            'marketCode': '0', 
-            'commodity_id': 'TXO', 
-            'queryDate': query_date, 
-            'MarketCode': '0', 
-            'commodity_idt': 'TXO'
-        }
-        
-        try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
-            if "查無資料" in res.text or len(res.text) < 500: 
-                continue
-            
-            dfs = pd.read_html(StringIO(res.text))
-            if not dfs: 
-                continue
-            df = dfs[0]
-            
-            # 精確欄位對應
-            col_map = {}
-            
-            for col in df.columns:
-                col_str = str(col).strip()
-                
-                if '未沖銷' in col_str and '契約量' in col_str:
-                    col_map['OI'] = col
-                elif '到期月份' in col_str or '週別' in col_str:
-                    col_map['Month'] = col
-                elif col_str == '契約' and 'Month' not in col_map:
-                    col_map['Month'] = col
-                elif '履約價' in col_str:
-                    col_map['Strike'] = col
-                elif '買賣權' in col_str:
-                    col_map['Type'] = col
-                elif '結算價' in col_str:
-                    col_map['Price'] = col
-                elif '收盤價' in col_str and 'Price' not in col_map:
-                    col_map['Price'] = col
-            
-            required = ['Month', 'Strike', 'Type', 'OI', 'Price']
-            if not all(k in col_map for k in required):
-                continue
-            
-            df_renamed = df.rename(columns={v: k for k, v in col_map.items()})
-            df_clean = df_renamed[required].dropna(subset=['Type'])
-            
-            df_clean['Type'] = df_clean['Type'].astype(str).str.strip()
-            df_clean['Strike'] = pd.to_numeric(df_clean['Strike'].astype(str).str.replace(',', ''), errors='coerce')
-            df_clean['OI'] = pd.to_numeric(df_clean['OI'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-            df_clean['Price'] = pd.to_numeric(df_clean['Price'].astype(str).str.replace(',', '').replace('-', '0'), errors='coerce').fillna(0)
-            df_clean['Amount'] = df_clean['OI'] * df_clean['Price'] * 50
-            
-            if df_clean['OI'].sum() > 0 and len(df_clean) > 10:
-                all_data.append({'date': query_date, 'df': df_clean})
-                if len(all_data) >= days: 
-                    break
-        except Exception as e:
-            continue
-            
+    """獲取選擇權全市場數據 (優先讀取歷史庫, 只抓缺少的日期)
+
+    只有已公布最終日報的日期 (<= latest_published_trading_date) 才入庫並視為已知,
+    盤中或公布前抓到的當日報表每次仍重新抓取, 避免暫定資料永久留在歷史庫。
+    """
+    query_dates = candidate_query_dates(max(30, days * 2))
+    published = latest_published_trading_date()
+    stored = {d: df for d, df in load_option_history('TXO', query_dates).items() if d <= published}
+    found = probe_recent_dates(
+        fetch_option_chain, query_dates, need=days, known=stored, deadline=Deadline(FETCH_DEADLINES['option_chain'])
+    )
+    # 多抓到的已公布日期也入庫, 之後不必重抓
+    for query_date, df_clean in found:
+        if query_date not in stored and query_date <= published:
+            save_option_history('TXO', query_date, df_clean)
+    found = found[:days]
+    all_data = [{'date': query_date, 'df': normalize_option_chain(df_clean)} for query_date, df_clean in found]
     return all_data if len(all_data) >= 1 else None
 
+# ==================== 盤中行情輪詢 ====================
+INTRADAY_POLL_SECONDS = int(os.environ.get("INTRADAY_POLL_SECONDS", "10"))
+INTRADAY_BUFFER_SIZE = 2000
+INTRADAY_SESSION = ((8, 45), (13, 45))  # 台指期日盤, 涵蓋現貨 09:00~13:30
+
+def is_intraday_session(now=None):
+    now = now or datetime.now(tz=TW_TZ)
+    (open_h, open_m), (close_h, close_m) = INTRADAY_SESSION
+    return is_trading_day(now.date()) and (open_h, open_m) <= (now.hour, now.minute) <= (close_h, close_m)
+
+def fetch_taiex_quote():
+    """TWSE MIS 加權指數最新成交價"""
+    url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch=tse_t00.tw&json=1&delay=0&_={int(time.time())}000"
+    quote = http_request('GET', url, deadline=Deadline(HTTP_QUOTE_BUDGET), retries=0, verify=True).json()['msgArray'][0]
+    value = quote.get('z', '-')
+    return float(value) if value not in ('-', '') else None
+
+def fetch_tx_quote():
+    """TAIFEX MIS 台指期近月最新成交價 (日盤)"""
+    url = "https://mis.taifex.com.tw/futures/api/getQuoteList"
+    payload = {
+        'MarketType': '0', 'SymbolType': 'F', 'KindID': '1', 'CID': 'TXF',
+        'ExpireMonth': '', 'RowSize': '全部', 'PageNo': '', 'SortColumn': '', 'AscDesc': 'A'
+    }
+    quotes = http_request('POST', url, deadline=Deadline(HTTP_QUOTE_BUDGET), retries=0, json=payload).json()['RtData']['QuoteList']
+    for quote in quotes:
+        if str(quote.get('SymbolID', '')).endswith('-F') and quote.get('CLastPrice'):
+            return float(quote['CLastPrice'])
+    return None
+
+class IntradayPoller:
+    """每個程序一條背景執行緒: 盤中每 interval 秒抓現貨與台指期近月, 存入環狀緩衝區供所有 session 讀取"""
+
+    def __init__(self, interval=INTRADAY_POLL_SECONDS, max_ticks=INTRADAY_BUFFER_SIZE):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.ticks = deque(maxlen=max_ticks)
+        threading.Thread(target=self.run, name='intraday-poller', daemon=True).start()
+
+    def poll_once(self):
+        executor = get_executor('source', 4)
+        futures = {'taiex': executor.submit(fetch_taiex_quote), 'futures': executor.submit(fetch_tx_quote)}
+        tick = {'ts': time.time()}
+        for key, future in futures.items():
+            try:
+                tick[key] = future.result()
+            except Exception:
+                tick[key] = None
+        if tick['taiex'] or tick['futures']:
+            with self.lock:
+                self.ticks.append(tick)
+
+    def run(self):
+        while True:
+            if is_intraday_session():
+                self.poll_once()
+            time.sleep(self.interval)
+
+    def latest(self, max_age=None):
+        """最新一筆行情, 超過 max_age 秒視為過期回傳 None"""
+        with self.lock:
+            tick = self.ticks[-1] if self.ticks else None
+        if tick is None or (max_age is not None and time.time() - tick['ts'] > max_age):
+            return None
+        return tick
+
+    def history(self):
+        with self.lock:
+            return pd.DataFrame(list(self.ticks))
+
+@st.cache_resource
+def get_intraday_poller():
+    return IntradayPoller()
+
+def get_live_tick():
+    """盤中輪詢到的最新行情 (不發出 HTTP 請求), 已過期則回傳 None"""
+    return get_intraday_poller().latest(max_age=INTRADAY_POLL_SECONDS * 3)
+
+def get_live_spot():
+    """優先使用盤中輪詢的現貨, 否則退回 get_realtime_data"""
+    tick = get_live_tick()
+    if tick and tick['taiex']:
+        return tick['taiex']
+    return get_realtime_data()
+
 # ==================== 數學計算函數 ====================
+IV_LOWER_BOUND, IV_UPPER_BOUND = 1e-4, 5.0
+SQRT_2PI = np.sqrt(2 * np.pi)
+
 def calculate_iv(option_price, spot_price, strike, time_to_expiry, option_type='call', risk_free_rate=0.015):
+    from scipy.stats import norm
     if option_price <= 0 or spot_price <= 0 or strike <= 0 or time_to_expiry <= 0: 
         return None
     sigma = 0.3
@@ -414,6 +1443,7 @@ def calculate_iv(option_price, spot_price, strike, time_to_expiry, option_type='
     return None
 
 def calculate_greeks(spot_price, strike, time_to_expiry, volatility, option_type='call', risk_free_rate=0.015):
+    from scipy.stats import norm
     if volatility is None or volatility <= 0 or time_to_expiry <= 0: 
         return None, None
     try:
@@ -427,52 +1457,162 @@ def calculate_greeks(spot_price, strike, time_to_expiry, volatility, option_type
     except: 
         return None, None
 
-def calculate_dealer_gex(df, spot_price, settlement_date):
+def calculate_iv_vectorized(option_price, spot_price, strike, time_to_expiry, is_call, risk_free_rate=0.015, tol=1e-4, max_iter=100):
+    """整條報價鏈一次求解隱含波動率 (Newton + 二分法保護), 無解回傳 NaN"""
+    price, spot, strike, t, is_call = np.broadcast_arrays(
+        np.asarray(option_price, dtype=float), np.asarray(spot_price, dtype=float),
+        np.asarray(strike, dtype=float), np.asarray(time_to_expiry, dtype=float),
+        np.asarray(is_call, dtype=bool)
+    )
+    shape = price.shape
+    price, spot, strike, t, is_call = (a.ravel() for a in (price, spot, strike, t, is_call))
+    iv = np.full(price.size, np.nan)
+
+    # 只對落在無套利區間內的報價求解 (深價內低於內含價值者無解)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disc_k = strike * np.exp(-risk_free_rate * t)
+        lower = np.where(is_call, np.maximum(spot - disc_k, 0), np.maximum(disc_k - spot, 0))
+        upper = np.where(is_call, spot, disc_k)
+        valid = (price > 0) & (spot > 0) & (strike > 0) & (t > 0) & (price > lower) & (price < upper)
+    idx = np.flatnonzero(valid)
+    if idx.size == 0:
+        return iv.reshape(shape)
+
+    p, s, k, tt, c = price[idx], spot[idx], strike[idx], t[idx], is_call[idx]
+    lo = np.full(idx.size, IV_LOWER_BOUND)
+    hi = np.full(idx.size, IV_UPPER_BOUND)
+    sigma = np.full(idx.size, 0.3)
+    done = np.zeros(idx.size, dtype=bool)
+
+    for _ in range(max_iter):
+        model, vega = _bs_price_vega(s, k, tt, sigma, c, risk_free_rate)
+        diff = model - p
+        done = np.abs(diff) < tol
+        if done.all():
+            break
+        # 價格對波動率單調遞增, 用目前的誤差方向收斂區間
+        hi = np.where(diff > 0, sigma, hi)
+        lo = np.where(diff < 0, sigma, lo)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = sigma - diff / vega
+        in_bracket = np.isfinite(newton) & (newton > lo) & (newton < hi)
+        sigma = np.where(done, sigma, np.where(in_bracket, newton, 0.5 * (lo + hi)))
+
+    iv[idx[done]] = sigma[done]
+    return iv.reshape(shape)
+
+def calculate_greeks_vectorized(spot_price, strike, time_to_expiry, volatility, is_call, risk_free_rate=0.015):
+    """向量化 Delta / Gamma, 波動率無效處回傳 NaN"""
+    from scipy.special import ndtr
+    spot_price = np.asarray(spot_price, dtype=float)
+    volatility = np.asarray(volatility, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sqrt_t = np.sqrt(time_to_expiry)
+        d1 = (np.log(spot_price / strike) + (risk_free_rate + 0.5 * volatility ** 2) * time_to_expiry) / (volatility * sqrt_t)
+        delta = np.where(is_call, ndtr(d1), ndtr(d1) - 1)
+        gamma = np.exp(-0.5 * d1 ** 2) / SQRT_2PI / (spot_price * volatility * sqrt_t)
+    invalid = ~(volatility > 0) | ~(np.asarray(time_to_expiry) > 0)
+    return np.where(invalid, np.nan, delta), np.where(invalid, np.nan, gamma)
+
+def _bs_price_vega(spot, strike, t, sigma, is_call, risk_free_rate):
+    from scipy.special import ndtr
+    sqrt_t = np.sqrt(t)
+    d1 = (np.log(spot / strike) + (risk_free_rate + 0.5 * sigma ** 2) * t) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    disc_k = strike * np.exp(-risk_free_rate * t)
+    call = spot * ndtr(d1) - disc_k * ndtr(d2)
+    price = np.where(is_call, call, call - spot + disc_k)
+    vega = spot * np.exp(-0.5 * d1 ** 2) / SQRT_2PI * sqrt_t
+    return price, vega
+
+def is_call_type(type_series):
+    return type_series.astype(str).str.contains('Call|買', na=False).to_numpy()
+
+def calculate_chain_greeks(df, spot_price, settlement_date):
+    """整條報價鏈的 IV / Delta / Gamma / GEX 表 (只含有價格的履約價)
+
+    settlement_date 為 {合約: 結算日} 時一次計算多個合約, 結果多一欄 Month。
+    """
+    df_priced = df[df['Price'] > 0]
+    by_month = isinstance(settlement_date, dict)
+    if by_month:
+        df_priced = df_priced[df_priced['Month'].isin(list(settlement_date))]
+        t_by_month = {code: get_time_to_expiry(s_date) for code, s_date in settlement_date.items()}
+        time_to_expiry = df_priced['Month'].map(t_by_month).astype(float).to_numpy()
+    else:
+        time_to_expiry = get_time_to_expiry(settlement_date)
+    strike = df_priced['Strike'].to_numpy(dtype=float)
+    oi = df_priced['OI'].to_numpy(dtype=float)
+    is_call = df_priced['is_call'].to_numpy()
+    iv = calculate_iv_vectorized(df_priced['Price'].to_numpy(dtype=float), spot_price, strike, time_to_expiry, is_call)
+    delta, gamma = calculate_greeks_vectorized(spot_price, strike, time_to_expiry, iv, is_call)
+    greeks = pd.DataFrame({
+        'Strike': strike,
+        'is_call': is_call,
+        'OI': oi,
+        'IV': iv,
+        'Delta': delta,
+        'Gamma': gamma,
+        'GEX': -gamma * oi * (spot_price ** 2) * 0.01
+    })
+    if by_month:
+        greeks.insert(0, 'Month', df_priced['Month'].to_numpy())
+    return greeks
+
+def calculate_dealer_gex(df, spot_price, settlement_date, greeks=None):
     try:
-        today = datetime.now(tz=TW_TZ)
-        expiry = datetime.strptime(settlement_date, '%Y/%m/%d').replace(tzinfo=TW_TZ)
-        time_to_expiry = max((expiry - today).days / 365.0, 0.001)
-        gex_data = []
-        for idx, row in df.iterrows():
-            strike = row['Strike']
-            oi = row['OI']
-            price = row['Price']
-            option_type = 'call' if 'Call' in str(row['Type']) or '買' in str(row['Type']) else 'put'
-            if price > 0 and oi > 0:
-                iv = calculate_iv(price, spot_price, strike, time_to_expiry, option_type)
-                if iv:
-                    delta, gamma = calculate_greeks(spot_price, strike, time_to_expiry, iv, option_type)
-                    if gamma:
-                        gex = -gamma * oi * (spot_price ** 2) * 0.01
-                        gex_data.append({'Strike': strike, 'Type': option_type, 'OI': oi, 'Gamma': gamma, 'GEX': gex})
-        if gex_data: 
-            return pd.DataFrame(gex_data).groupby('Strike')['GEX'].sum().reset_index()
+        if greeks is None:
+            greeks = calculate_chain_greeks(df, spot_price, settlement_date)
+        gex_rows = greeks[(greeks['OI'] > 0) & np.isfinite(greeks['Gamma']) & (greeks['Gamma'] != 0)]
+        if not gex_rows.empty: 
+            return gex_rows.groupby('Strike')['GEX'].sum().reset_index()
     except: 
         pass
     return None
 
-def calculate_risk_reversal(df, spot_price, settlement_date):
+GEX_PROFILE_RANGE = 1500
+GEX_PROFILE_STEP = 10
+
+def calculate_gex_profile(greeks, spot_price, settlement_date, span=GEX_PROFILE_RANGE, step=GEX_PROFILE_STEP):
+    """假設現貨落在 spot ± span (每 step 點) 時的總 Dealer Gamma, IV 固定, 以 (價位 × 履約價) 廣播一次算完
+
+    翻轉點採業界慣例 (Call Gamma 為正、Put 為負); 逐履約價 GEX 假設莊家全為賣方, 總和恆為負而沒有翻轉點。
+    回傳 (DataFrame[Spot, GEX], Gamma 翻轉價位或 None)
+    """
+    rows = greeks[np.isfinite(greeks['IV']) & (greeks['OI'] > 0)]
+    if rows.empty:
+        return None, None
+    grid = np.arange(spot_price - span, spot_price + span + step / 2, step)
+    is_call = rows['is_call'].to_numpy()
+    _, gamma = calculate_greeks_vectorized(
+        grid[:, None], rows['Strike'].to_numpy(dtype=float), get_time_to_expiry(settlement_date),
+        rows['IV'].to_numpy(dtype=float), is_call
+    )
+    signed_oi = np.where(is_call, 1.0, -1.0) * rows['OI'].to_numpy(dtype=float)
+    gex = np.nan_to_num(gamma) @ signed_oi * grid ** 2 * 0.01
+    return pd.DataFrame({'Spot': grid, 'GEX': gex}), find_gamma_flip(grid, gex, spot_price)
+
+def find_gamma_flip(grid, gex, spot_price):
+    """總 Gamma 由負轉正 (或反之) 的價位, 多個時取最接近現貨者, 以線性內插"""
+    crossings = np.flatnonzero(np.sign(gex[:-1]) * np.sign(gex[1:]) < 0)
+    if crossings.size == 0:
+        return None
+    levels = grid[crossings] - gex[crossings] * (grid[crossings + 1] - grid[crossings]) / (gex[crossings + 1] - gex[crossings])
+    return float(levels[np.abs(levels - spot_price).argmin()])
+
+def calculate_risk_reversal(df, spot_price, settlement_date, greeks=None):
     try:
-        today = datetime.now(tz=TW_TZ)
-        expiry = datetime.strptime(settlement_date, '%Y/%m/%d').replace(tzinfo=TW_TZ)
-        time_to_expiry = max((expiry - today).days / 365.0, 0.001)
-        atm_strike = min(df['Strike'], key=lambda x: abs(x - spot_price))
-        iv_delta_data = []
-        for idx, row in df.iterrows():
-            strike = row['Strike']
-            price = row['Price']
-            option_type = 'call' if 'Call' in str(row['Type']) or '買' in str(row['Type']) else 'put'
-            if price > 0:
-                iv = calculate_iv(price, spot_price, strike, time_to_expiry, option_type)
-                if iv:
-                    delta, _ = calculate_greeks(spot_price, strike, time_to_expiry, iv, option_type)
-                    if delta: 
-                        iv_delta_data.append({'Strike': strike, 'Type': option_type, 'IV': iv, 'Delta': abs(delta)})
-        if not iv_delta_data: 
+        if greeks is None:
+            greeks = calculate_chain_greeks(df, spot_price, settlement_date)
+        strikes = df['Strike'].to_numpy()
+        atm_strike = strikes[np.abs(strikes - spot_price).argmin()]
+        iv_df = greeks[np.isfinite(greeks['Delta']) & (greeks['Delta'] != 0)]
+        if iv_df.empty: 
             return None, None, None
-        iv_df = pd.DataFrame(iv_delta_data)
-        call_25d = iv_df[(iv_df['Type'] == 'call') & (iv_df['Delta'] > 0.2) & (iv_df['Delta'] < 0.3)]
-        put_25d = iv_df[(iv_df['Type'] == 'put') & (iv_df['Delta'] > 0.2) & (iv_df['Delta'] < 0.3)]
+        abs_delta = iv_df['Delta'].abs()
+        in_25d = (abs_delta > 0.2) & (abs_delta < 0.3)
+        call_25d = iv_df[iv_df['is_call'] & in_25d]
+        put_25d = iv_df[~iv_df['is_call'] & in_25d]
         atm_iv = iv_df[iv_df['Strike'] == atm_strike]['IV'].mean()
         if not call_25d.empty and not put_25d.empty:
             rr = call_25d.iloc[0]['IV'] - put_25d.iloc[0]['IV']
@@ -481,52 +1621,193 @@ def calculate_risk_reversal(df, spot_price, settlement_date):
     except: 
         return None, None, None
 
-def calculate_multi_day_oi_change(all_data):
+# ==================== Max Pain ====================
+def calculate_pain_curve(df):
+    """各合約在每個履約價結算時買方的履約價值 (新台幣), 最小者即 Max Pain
+
+    依 (Month, Strike) 排序後以分組累加計算, O(K log K), 所有合約一次完成:
+      Call_Pain(S) = S * ΣOI_c(K<=S) - Σ(OI_c * K)(K<=S)
+      Put_Pain(S)  = Σ(OI_p * K)(K>=S) - S * ΣOI_p(K>=S)
+    """
+    oi = df.groupby(['Month', 'Strike', 'is_call'], observed=True)['OI'].sum().unstack('is_call', fill_value=0)
+    oi = oi.reindex(columns=[True, False], fill_value=0)
+    curve = pd.DataFrame({'Call_OI': oi[True], 'Put_OI': oi[False]}).reset_index()
+    strike = curve['Strike'].to_numpy(dtype=float)
+    call_oi = curve['Call_OI'].to_numpy(dtype=float)
+    put_oi = curve['Put_OI'].to_numpy(dtype=float)
+    sums = pd.DataFrame({'c': call_oi, 'ck': call_oi * strike, 'p': put_oi, 'pk': put_oi * strike})
+    by_month = sums.groupby(curve['Month'].to_numpy(), sort=False)
+    below = by_month.cumsum()
+    above = by_month.transform('sum') - below + sums
+    curve['Call_Pain'] = (strike * below['c'] - below['ck']) * 50
+    curve['Put_Pain'] = (above['pk'] - strike * above['p']) * 50
+    curve['Pain'] = curve['Call_Pain'] + curve['Put_Pain']
+    return curve
+
+def max_pain_by_contract(curve):
+    """{合約: Max Pain 履約價}"""
+    if curve.empty:
+        return {}
+    rows = curve.loc[curve.groupby('Month', observed=True)['Pain'].idxmin()]
+    return dict(zip(rows['Month'].astype(str), rows['Strike'].astype(int)))
+
+# ==================== 未平倉歷史 ====================
+OI_HISTORY_VIEW_DAYS = 21  # 最新一日 + 前 20 個交易日
+OI_CHANGE_LAGS = (1, 5, 20)
+OI_HISTORY_KEYS = ['Month', 'Strike', 'is_call']
+
+def _oi_matrix(all_data):
+    """將各日 (Month, Strike, is_call) 編成整數 key 對齊: 回傳 (月份表, 排序後 key, 未平倉矩陣, 各日列位置)"""
+    months = pd.Index(sorted(set().union(*(d['df']['Month'].cat.categories for d in all_data))))
+    day_keys = []
+    for d in all_data:
+        df = d['df']
+        month_code = months.get_indexer(df['Month'].cat.categories).astype(np.int64)[df['Month'].cat.codes]
+        day_keys.append((month_code << 33) | (df['Strike'].to_numpy(dtype=np.int64) << 1) | df['is_call'].to_numpy(dtype=np.int64))
+    keys, inverse = np.unique(np.concatenate(day_keys), return_inverse=True)
+    matrix = np.zeros((keys.size, len(all_data)), dtype=np.int64)
+    positions = np.split(inverse, np.cumsum([k.size for k in day_keys])[:-1])
+    for day, (rows, d) in enumerate(zip(positions, all_data)):
+        matrix[rows, day] = d['df']['OI'].to_numpy()
+    return months, keys, matrix, positions
+
+def build_oi_history(all_data):
+    """多日未平倉矩陣: index 為 (Month, Strike, is_call), 每個交易日一欄 (新到舊), 當日無此序列為 0"""
+    months, keys, matrix, _ = _oi_matrix(all_data)
+    index = pd.MultiIndex.from_arrays(
+        [months[keys >> 33], ((keys >> 1) & (2 ** 32 - 1)).astype(np.int32), (keys & 1).astype(bool)],
+        names=OI_HISTORY_KEYS
+    )
+    return pd.DataFrame(matrix, index=index, columns=[d['date'] for d in all_data])
+
+def oi_changes(history, lags):
+    """各序列最新一日相對 lag 個交易日前的未平倉變化 (OI_Change_D{lag}), 資料不足的 lag 略過"""
+    lags = [lag for lag in lags if lag < history.shape[1]]
+    values = history.to_numpy()
+    return pd.DataFrame(
+        values[:, [0]] - values[:, lags],
+        index=history.index,
+        columns=[f'OI_Change_D{lag}' for lag in lags]
+    )
+
+def oi_buildup_days(history):
+    """連續增倉天數: 由最新一日往回, 未平倉逐日增加的交易日數"""
+    values = history.to_numpy()
+    rising = values[:, :-1] > values[:, 1:]
+    return pd.Series(np.cumprod(rising, axis=1).sum(axis=1), index=history.index, name='Buildup_Days')
+
+def peak_oi_strikes(history, contract_code):
+    """每日未平倉最大的 Call (壓力) / Put (支撐) 履約價, 依日期由舊到新; 沒有某一方的合約該方為 NaN"""
+    contract = history.xs(contract_code, level='Month')
+    sides = contract.index.get_level_values('is_call')
+    peaks = {}
+    for is_call, side in ((True, 'Call'), (False, 'Put')):
+        if not (sides == is_call).any():
+            peaks[f'{side}_Strike'] = pd.Series(np.nan, index=contract.columns)
+            peaks[f'{side}_OI'] = pd.Series(0, index=contract.columns)
+            continue
+        by_day = contract.xs(is_call, level='is_call')
+        peak_oi = by_day.max()
+        peaks[f'{side}_Strike'] = by_day.idxmax().where(peak_oi > 0)
+        peaks[f'{side}_OI'] = peak_oi
+    return pd.DataFrame(peaks).iloc[::-1]
+
+def calculate_multi_day_oi_change(all_data, lags=None):
+    """最新一日報價鏈加上 OI_Change_D{lag} 欄位 (預設為每個較舊的交易日)"""
     if not all_data or len(all_data) < 1: 
         return None
     df_latest = all_data[0]['df'].copy()
     if len(all_data) > 1:
-        for i in range(1, len(all_data)):
-            df_prev = all_data[i]['df'].copy()
-            df_merged = pd.merge(
-                df_latest[['Month', 'Strike', 'Type', 'OI']], 
-                df_prev[['Month', 'Strike', 'Type', 'OI']], 
-                on=['Month', 'Strike', 'Type'], 
-                how='left', 
-                suffixes=('', f'_D{i}')
-            ).fillna(0)
-            df_latest[f'OI_Change_D{i}'] = df_merged['OI'] - df_merged[f'OI_D{i}']
+        _, _, matrix, positions = _oi_matrix(all_data)
+        lags = [lag for lag in (lags or range(1, len(all_data))) if lag < len(all_data)]
+        latest = matrix[positions[0]]
+        df_latest[[f'OI_Change_D{lag}' for lag in lags]] = latest[:, [0]] - latest[:, lags]
     return df_latest
 
+def oi_history_view(all_data, contract_code, top_n=20):
+    """近 N 日未平倉檢視: (未平倉前 top_n 履約價的 D1/D5/D20 變化與連續增倉天數, 每日最大未平倉履約價)"""
+    history = build_oi_history(all_data)
+    if contract_code not in history.index.get_level_values('Month'):
+        return None, None
+    table = pd.concat([history.iloc[:, 0].rename('OI'), oi_changes(history, OI_CHANGE_LAGS), oi_buildup_days(history)], axis=1)
+    table = table.xs(contract_code, level='Month').reset_index()
+    table = table[table['OI'] > 0].nlargest(top_n, 'OI').sort_values('Strike')
+    table.insert(1, 'Type', np.where(table.pop('is_call'), '買權', '賣權'))
+    return table.reset_index(drop=True), peak_oi_strikes(history, contract_code)
+
+@st.cache_data(ttl=300, max_entries=16, show_spinner=False)
+def get_oi_history_view(data_date, contract_code, days, _all_data):
+    return oi_history_view(_all_data, contract_code)
+
 # ==================== 圖表繪製函數 ====================
+TORNADO_FOCUS_RANGE = 1200
+TORNADO_SPOT_BUCKET = 5
+FIGURE_CACHE_TTL = 1800
+FIGURE_CACHE_MAX_ENTRIES = 64
+
+def change_labels(change, oi):
+    """未平倉變化標籤 (+123 / -45), 該側無未平倉時留空"""
+    change = change.astype(int)
+    labels = np.where(change > 0, '+', '') + change.astype(str)
+    return np.where(oi > 0, labels, '')
+
+def tornado_frame(df_target):
+    """每個履約價一列的 Call / Put 未平倉、金額與單日變化 (一次分組取代 merge + 逐列 apply)"""
+    values = {'OI': 'OI', 'Amount': 'Amt'}
+    if 'OI_Change_D1' in df_target.columns:
+        values['OI_Change_D1'] = 'Change'
+    side = df_target['is_call'].map({True: 'Call', False: 'Put'})
+    data = df_target.groupby(['Strike', side])[list(values)].sum().unstack(fill_value=0)
+    data = data.reindex(columns=pd.MultiIndex.from_product([list(values), ['Call', 'Put']]), fill_value=0)
+    data.columns = [f"{s}_{values[v]}" for v, s in data.columns]
+    data = data.reset_index().sort_values('Strike')
+    data['Strike'] = data['Strike'].astype(int)
+    data[['Call_OI', 'Put_OI']] = data[['Call_OI', 'Put_OI']].astype(int)
+    if 'Call_Change' in data.columns:
+        data['Call_Text'] = change_labels(data['Call_Change'], data['Call_OI'])
+        data['Put_Text'] = change_labels(data['Put_Change'], data['Put_OI'])
+    else:
+        data['Call_Text'] = ""
+        data['Put_Text'] = ""
+    return data
+
+@st.cache_resource
+def get_figure_cache():
+    return TTLCache(FIGURE_CACHE_TTL, FIGURE_CACHE_MAX_ENTRIES)
+
+def cached_figure(key, build):
+    """以 key 快取序列化後的圖表 JSON, 命中時直接還原而不重建圖表"""
+    import plotly.graph_objects as go
+    cache = get_figure_cache()
+    fig_json = cache.get(key)
+    if fig_json is None:
+        fig_json = build().to_json()
+        cache.put(key, fig_json)
+    # JSON 來自已驗證過的 Figure, 還原時略過逐屬性驗證
+    return go.Figure(json.loads(fig_json), _validate=False)
+
+def tornado_figure(data_date, contract_code, df_target, spot_price):
+    """龍捲風圖 (快取 key: 數據日, 合約, 現貨取整至 TORNADO_SPOT_BUCKET 點)"""
+    spot_key = bucket_spot(spot_price, TORNADO_SPOT_BUCKET)
+    return cached_figure(
+        ('tornado', data_date, contract_code, spot_key),
+        lambda: plot_tornado_chart(df_target, f"{contract_code} 合約", spot_key)
+    )
+
 def plot_tornado_chart(df_target, title_text, spot_price):
-    is_call = df_target['Type'].str.contains('買|Call', case=False, na=False)
-    df_call = df_target[is_call][['Strike', 'OI', 'Amount']].rename(columns={'OI': 'Call_OI', 'Amount': 'Call_Amt'})
-    df_put = df_target[~is_call][['Strike', 'OI', 'Amount']].rename(columns={'OI': 'Put_OI', 'Amount': 'Put_Amt'})
-    data = pd.merge(df_call, df_put, on='Strike', how='outer').fillna(0).sort_values('Strike')
+    import plotly.graph_objects as go
+    data = tornado_frame(df_target)
     
     total_call_amt = data['Call_Amt'].sum()
     total_put_amt = data['Put_Amt'].sum()
     
-    FOCUS_RANGE = 1200
     center_price = spot_price if (spot_price and spot_price > 0) else data['Strike'].median()
     if center_price > 0:
-        data = data[(data['Strike'] >= center_price - FOCUS_RANGE) & (data['Strike'] <= center_price + FOCUS_RANGE)]
+        data = data[(data['Strike'] >= center_price - TORNADO_FOCUS_RANGE) & (data['Strike'] <= center_price + TORNADO_FOCUS_RANGE)]
     
     max_oi = max(data['Put_OI'].max(), data['Call_OI'].max()) if not data.empty else 1000
     x_limit = max_oi * 1.1
 
-    data['Put_Text'] = ""
-    data['Call_Text'] = ""
-    if 'OI_Change_D1' in df_target.columns:
-        df_chg = df_target[['Strike', 'Type', 'OI_Change_D1']].copy()
-        call_c = df_chg[df_chg['Type'].str.contains('Call|買')].set_index('Strike')['OI_Change_D1']
-        put_c = df_chg[~df_chg['Type'].str.contains('Call|買')].set_index('Strike')['OI_Change_D1']
-        data['Call_Change'] = data['Strike'].map(call_c).fillna(0)
-        data['Put_Change'] = data['Strike'].map(put_c).fillna(0)
-        data['Put_Text'] = data.apply(lambda r: f"{'+' if r['Put_Change']>0 else ''}{int(r['Put_Change'])}" if r['Put_OI']>0 else "", axis=1)
-        data['Call_Text'] = data.apply(lambda r: f"{'+' if r['Call_Change']>0 else ''}{int(r['Call_Change'])}" if r['Call_OI']>0 else "", axis=1)
-
     fig = go.Figure()
     fig.add_trace(go.Bar(
         y=data['Strike'], 
@@ -538,7 +1819,7 @@ def plot_tornado_chart(df_target, title_text, spot_price):
         text=data['Put_Text'], 
         textposition='outside', 
         hovertemplate='Put OI: %{x}<br>Amt: %{customdata:.2f}億', 
-        customdata=data['Put_Amt']/1e8
+        customdata=(data['Put_Amt'] / 1e8).round(2)
     ))
     fig.add_trace(go.Bar(
         y=data['Strike'], 
@@ -550,7 +1831,7 @@ def plot_tornado_chart(df_target, title_text, spot_price):
         text=data['Call_Text'], 
         textposition='outside', 
         hovertemplate='Call OI: %{x}<br>Amt: %{customdata:.2f}億', 
-        customdata=data['Call_Amt']/1e8
+        customdata=(data['Call_Amt'] / 1e8).round(2)
     ))
     
     if spot_price:
@@ -604,7 +1885,119 @@ def plot_tornado_chart(df_target, title_text, spot_price):
     )
     return fig
 
+def pain_figure(data_date, contract_code, pain_curve, max_pain, spot_price):
+    """痛苦曲線圖 (快取 key 與龍捲風圖相同)"""
+    spot_key = bucket_spot(spot_price, TORNADO_SPOT_BUCKET)
+    return cached_figure(
+        ('pain', data_date, contract_code, spot_key),
+        lambda: plot_pain_chart(pain_curve, max_pain, spot_key)
+    )
+
+def plot_pain_chart(pain_curve, max_pain, spot_price):
+    """縱軸為履約價 (與龍捲風圖對齊), 橫軸為該價位結算時買方履約價值"""
+    import plotly.graph_objects as go
+    center_price = spot_price if (spot_price and spot_price > 0) else max_pain
+    data = pain_curve
+    if center_price:
+        data = data[(data['Strike'] >= center_price - TORNADO_FOCUS_RANGE) & (data['Strike'] <= center_price + TORNADO_FOCUS_RANGE)]
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        y=data['Strike'], x=(data['Put_Pain'] / 1e8).round(2), orientation='h',
+        name='Put', marker_color='#2ca02c', opacity=0.85, hovertemplate='Put: %{x:.2f}億'
+    ))
+    fig.add_trace(go.Bar(
+        y=data['Strike'], x=(data['Call_Pain'] / 1e8).round(2), orientation='h',
+        name='Call', marker_color='#d62728', opacity=0.85, hovertemplate='Call: %{x:.2f}億'
+    ))
+    if max_pain:
+        fig.add_hline(y=max_pain, line_dash="dot", line_color="#9467bd", line_width=2)
+        fig.add_annotation(
+            x=1, xref='paper', xanchor='right', y=max_pain, text=f"Max Pain {max_pain:,}",
+            showarrow=False, bgcolor="#9467bd", font=dict(color="white")
+        )
+    if spot_price:
+        fig.add_hline(y=spot_price, line_dash="dash", line_color="#ff7f0e", line_width=2)
+    fig.update_layout(
+        title=dict(text="結算痛苦曲線 (Max Pain)", x=0.5),
+        xaxis_title="買方履約價值 (億)",
+        yaxis=dict(tickformat=",", separatethousands=True),
+        barmode='stack',
+        height=750,
+        showlegend=False
+    )
+    return fig
+
+def plot_peak_oi_chart(peaks, spot_price, title_text):
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=peaks.index, y=peaks['Call_Strike'], mode='lines+markers', name='Call 最大未平倉 (壓力)',
+        line=dict(color='#d62728'), customdata=peaks['Call_OI'], hovertemplate='%{y:,}<br>OI: %{customdata:,}'
+    ))
+    fig.add_trace(go.Scatter(
+        x=peaks.index, y=peaks['Put_Strike'], mode='lines+markers', name='Put 最大未平倉 (支撐)',
+        line=dict(color='#2ca02c'), customdata=peaks['Put_OI'], hovertemplate='%{y:,}<br>OI: %{customdata:,}'
+    ))
+    if spot_price:
+        fig.add_hline(y=spot_price, line_dash="dash", line_color="#ff7f0e")
+    fig.update_layout(
+        title=title_text,
+        xaxis=dict(type='category'),
+        yaxis=dict(tickformat=",", separatethousands=True),
+        height=400,
+        legend=dict(orientation='h', y=-0.2)
+    )
+    return fig
+
+def gex_figures(data_date, contract_code, analytics, spot_price):
+    """GEX 長條圖與 GEX-現貨曲線 (快取 key 另含計算 Greeks 時的現貨, 只有現貨線隨 spot_price 移動)"""
+    spot_key = bucket_spot(spot_price, TORNADO_SPOT_BUCKET)
+    key = (data_date, contract_code, analytics['spot'], spot_key)
+    fig_gex = fig_profile = None
+    if analytics['gex'] is not None and not analytics['gex'].empty:
+        fig_gex = cached_figure(('gex',) + key, lambda: plot_gex_chart(analytics['gex'], spot_key))
+    if analytics['gex_profile'] is not None:
+        fig_profile = cached_figure(
+            ('gex_profile',) + key, lambda: plot_gex_profile_chart(analytics['gex_profile'], spot_key, analytics['gamma_flip'])
+        )
+    return fig_gex, fig_profile
+
+def plot_gex_profile_chart(profile, spot_price, gamma_flip):
+    import plotly.graph_objects as go
+    if profile is None or profile.empty:
+        return None
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=profile['Spot'], y=profile['GEX'].clip(lower=0), fill='tozeroy', mode='none',
+        fillcolor='rgba(44,160,44,0.35)', hoverinfo='skip'
+    ))
+    fig.add_trace(go.Scatter(
+        x=profile['Spot'], y=profile['GEX'].clip(upper=0), fill='tozeroy', mode='none',
+        fillcolor='rgba(214,39,40,0.35)', hoverinfo='skip'
+    ))
+    fig.add_trace(go.Scatter(
+        x=profile['Spot'], y=profile['GEX'], mode='lines', line=dict(color='#444'),
+        hovertemplate='現貨 %{x:,.0f}<br>GEX: %{y:,.0f}'
+    ))
+    if spot_price:
+        fig.add_vline(x=spot_price, line_dash="dash", line_color="orange")
+    if gamma_flip:
+        fig.add_vline(
+            x=gamma_flip, line_dash="dot", line_color="#9467bd",
+            annotation_text=f"Gamma Flip {gamma_flip:,.0f}", annotation_position="top"
+        )
+    fig.update_layout(
+        title="總 Gamma 曝險 vs 現貨 (IV 固定)",
+        xaxis_title="假設現貨",
+        yaxis_title="GEX",
+        xaxis=dict(tickformat=",", separatethousands=True),
+        height=400,
+        showlegend=False
+    )
+    return fig
+
 def plot_gex_chart(gex_df, spot_price):
+    import plotly.graph_objects as go
     if gex_df is None or gex_df.empty: 
         return None
     fig = go.Figure()
@@ -626,7 +2019,7 @@ def plot_gex_chart(gex_df, spot_price):
     return fig
 
 # ==================== AI 相關函數 ====================
-def prepare_ai_data(df, inst_opt_data, inst_fut, futures_price, spot_price, basis, atm_iv, risk_reversal, gex_summary, data_date):
+def prepare_ai_data(df, inst_opt_data, inst_fut, futures_price, spot_price, basis, atm_iv, risk_reversal, gex_summary, data_date, max_pain=None):
     df_ai = df.nlargest(30, 'Amount') if 'Amount' in df.columns else df
     cols = [c for c in ['Strike','Type','OI','Amount','OI_Change_D1'] if c in df_ai.columns]
     
@@ -653,6 +2046,7 @@ def prepare_ai_data(df, inst_opt_data, inst_fut, futures_price, spot_price, basi
     return f"""
     數據日期: {data_date}
     現貨: {spot_price}, 期貨: {futures_price}, 基差: {basis}
+    Max Pain (已計算): {max_pain if max_pain else 'N/A'}
     ATM IV: {atm_iv}, Risk Reversal: {risk_reversal}
     Dealer GEX 重點: {gex_str}
     
@@ -669,7 +2063,7 @@ def prepare_ai_data(df, inst_opt_data, inst_fut, futures_price, spot_price, basi
 def build_ai_prompt(data_str, taiex_price):
     return f"""
     你是台指期莊家分析師。
-    目標：分析籌碼結構,預判結算行情 (Max Pain)。
+    目標：分析籌碼結構,預判結算行情 (Max Pain 已計算, 直接引用)。
     
     現貨價格：{taiex_price}
     
@@ -683,35 +2077,388 @@ def build_ai_prompt(data_str, taiex_price):
     {data_str}
     """
 
-def ask_gemini(prompt):
-    if not gemini_model: 
-        return "未設定 Gemini Key"
-    try: 
-        return gemini_model.generate_content(prompt).text
-    except Exception as e: 
-        return str(e)
+def stream_gemini(prompt):
+    """逐段產出 Gemini 回應文字"""
+    gemini_model, _ = get_gemini()
+    for chunk in gemini_model.generate_content(prompt, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:
+            # 無文字內容的區段 (例如僅含結束原因)
+            continue
+        if text:
+            yield text
+
+def stream_chatgpt(prompt):
+    """逐段產出 ChatGPT 回應文字"""
+    stream = get_openai().chat.completions.create(
+        model=OPENAI_MODEL, 
+        messages=[{"role":"user","content":prompt}],
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+class AILatencyLog:
+    """各 AI 供應商的首字時間 (TTFT) / 完成時間 / 錯誤紀錄"""
+
+    def __init__(self, max_records=200):
+        self.lock = threading.Lock()
+        self.records = deque(maxlen=max_records)
+
+    def record(self, provider, ttft, total, ok):
+        with self.lock:
+            self.records.append({'provider': provider, 'ttft': ttft, 'total': total, 'ok': ok})
+
+    def summary(self):
+        with self.lock:
+            df = pd.DataFrame(list(self.records))
+        if df.empty:
+            return df
+        ok = df[df['ok']]
+        return pd.DataFrame([
+            {
+                '供應商': provider,
+                '次數': int((df['provider'] == provider).sum()),
+                '首字中位數(秒)': round(ok.loc[ok['provider'] == provider, 'ttft'].median(), 2),
+                '完成中位數(秒)': round(ok.loc[ok['provider'] == provider, 'total'].median(), 2),
+                '錯誤率': f"{(~df.loc[df['provider'] == provider, 'ok']).mean():.0%}",
+            }
+            for provider in df['provider'].unique()
+        ])
 
-def ask_chatgpt(prompt):
-    if not openai_client: 
-        return "未設定 OpenAI Key"
+@st.cache_resource
+def get_ai_latency_log():
+    return AILatencyLog()
+
+def stream_ai(provider, prompt, on_token=None):
+    """串流呼叫 AI, 每收到一段就以累積文字呼叫 on_token; 回傳 (全文, 首字秒數, 總秒數)"""
+    stream = stream_gemini if provider == 'gemini' else stream_chatgpt
+    start = time.perf_counter()
+    ttft = None
+    parts = []
     try:
-        res = openai_client.chat.completions.create(
-            model="gpt-4o-mini", 
-            messages=[{"role":"user","content":prompt}]
-        )
-        return res.choices[0].message.content
-    except Exception as e: 
-        return str(e)
+        for piece in stream(prompt):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            parts.append(piece)
+            if on_token is not None:
+                on_token("".join(parts))
+    except Exception:
+        get_ai_latency_log().record(provider, ttft, time.perf_counter() - start, False)
+        raise
+    total = time.perf_counter() - start
+    get_ai_latency_log().record(provider, ttft if ttft is not None else total, total, True)
+    return "".join(parts), ttft if ttft is not None else total, total
+
+@st.cache_resource
+def get_ai_result_cache():
+    return TTLCache(ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES)
+
+def ai_result_key(provider, data_date, contract_code, spot_price):
+    """AI 結果快取 key: 供應商 + 模型 + (數據日, 合約, 現貨取整) 指紋"""
+    model = get_gemini()[1] if provider == 'gemini' else OPENAI_MODEL
+    spot_bucket = bucket_spot(spot_price, AI_SPOT_BUCKET)
+    return provider, model, fingerprint(data_date, contract_code, spot_bucket)
+
+def ask_ai_cached(provider, cache_key, build_prompt, on_token=None):
+    """相同 key 直接回傳快取結果 (不重建 prompt); 錯誤訊息不快取
+
+    回傳 {'text', 'cached', 'ttft', 'total'}; 同 key 同時進行的請求共用一次串流呼叫。
+    """
+    cache = get_ai_result_cache()
+    result = cache.get(cache_key)
+    if result is not None:
+        return {'text': result, 'ok': True, 'cached': True, 'ttft': None, 'total': None}
+    if provider == 'gemini' and not get_gemini()[0]:
+        return {'text': "未設定 Gemini Key", 'ok': False, 'cached': False, 'ttft': None, 'total': None}
+    if provider != 'gemini' and not get_openai():
+        return {'text': "未設定 OpenAI Key", 'ok': False, 'cached': False, 'ttft': None, 'total': None}
+    
+    def run():
+        text, ttft, total = stream_ai(provider, build_prompt(), on_token)
+        cache.put(cache_key, text)
+        return {'text': text, 'ok': True, 'cached': False, 'ttft': ttft, 'total': total}
+    
+    try:
+        return get_single_flight().do(f"ai:{provider}", cache_key, run)
+    except Exception as e:
+        return {'text': str(e), 'ok': False, 'cached': False, 'ttft': None, 'total': None}
+
+@st.cache_resource
+def get_ai_hedge_calls():
+    """落後供應商的呼叫 {cache_key: future}, 失敗結果也保留到過期, rerun 時不重複付費呼叫"""
+    return TTLCache(ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES)
+
+def hedge_call(provider, cache_key, build_prompt):
+    """取得 (或建立) 對照用的背景呼叫; 同 key 已有進行中或已完成的呼叫時沿用"""
+    calls = get_ai_hedge_calls()
+    future = calls.get(cache_key)
+    if future is None:
+        future = submit_task(get_executor('ai', 4), ask_ai_cached, provider, cache_key, build_prompt)
+        calls.put(cache_key, future)
+    return future
+
+def ask_ai_hedged(cache_keys, build_prompt, on_token=None):
+    """同時詢問所有供應商, 先完成且有效的回應勝出
+
+    先吐出文字的供應商取得 on_token 串流顯示; 落後者不中斷, 呼叫記錄在 get_ai_hedge_calls 供對照。
+    回傳 (勝出供應商, 勝出結果, {其他供應商: future})。
+    """
+    cache = get_ai_result_cache()
+    for provider, cache_key in cache_keys.items():
+        text = cache.get(cache_key)
+        if text is not None:
+            others = {p: hedge_call(p, k, build_prompt) for p, k in cache_keys.items() if p != provider}
+            return provider, {'text': text, 'ok': True, 'cached': True, 'ttft': None, 'total': None}, others
+    
+    prompt = build_prompt()
+    lock = threading.Lock()
+    streaming = {'provider': None, 'closed': False}
+    
+    def token_handler(provider):
+        def handle(text):
+            with lock:
+                if streaming['closed']:
+                    return
+                if streaming['provider'] is None:
+                    streaming['provider'] = provider
+                is_streaming = streaming['provider'] == provider
+                # 在鎖內寫入, 勝出者決定後不會再有落後者的文字覆蓋頁面
+                if is_streaming and on_token is not None:
+                    on_token(text)
+        return handle
+    
+    executor = get_executor('ai', 4)
+    futures = {
+        submit_task(executor, ask_ai_cached, provider, cache_key, lambda: prompt, token_handler(provider)): provider
+        for provider, cache_key in cache_keys.items()
+    }
+    winner, winner_result = None, None
+    for future in as_completed(futures):
+        result = future.result()
+        if result['ok'] or winner is None:
+            winner, winner_result = futures[future], result
+        if result['ok']:
+            break
+    with lock:
+        streaming['closed'] = True
+    others = {provider: future for future, provider in futures.items() if provider != winner}
+    for provider, future in others.items():
+        get_ai_hedge_calls().put(cache_keys[provider], future)
+    return winner, winner_result, others
+
+def render_hedge_result(provider, future, polling=False):
+    """對照供應商的結果 (不阻塞頁面); 未完成時由 fragment 每 AI_HEDGE_POLL_SECONDS 秒重新檢查
+
+    polling 的 fragment 發現已完成時整頁重跑一次, 改以不輪詢的 fragment 顯示結果。
+    """
+    if not future.done():
+        st.caption("⏳ 尚未完成, 完成後會自動顯示")
+        return
+    if polling:
+        st.rerun()
+    result = future.result()
+    if result['ok']:
+        st.markdown(result['text'])
+    else:
+        st.caption(f"❌ {AI_PROVIDER_LABELS[provider]} 回應失敗: {result['text']}")
 
 def get_next_contracts(df, data_date):
     """從數據中提取未結算的合約"""
-    unique_codes = sorted(df['Month'].unique())
-    targets = []
-    for code in unique_codes:
-        s_date = get_settlement_date(code)
-        if s_date >= data_date:
-            targets.append({'code': code, 'date': s_date})
-    return targets
+    settlement = df.groupby('Month', observed=True)['Settlement'].first()
+    return [{'code': code, 'date': s_date} for code, s_date in settlement.items() if s_date >= data_date]
+
+# ==================== 合約分析 (頁面與 API 共用) ====================
+OI_HISTORY_DAYS = 2
+ANALYTICS_SPOT_BUCKET = 10  # Greeks / GEX 以取整後的現貨計算, 現貨小幅跳動不必重算
+ANALYTICS_API_PORT = os.environ.get("ANALYTICS_API_PORT", "")
+
+def contract_result(data_date, contract_code, settlement_date, spot_price, df_selected, call_amt, put_amt, greeks, pain_curve):
+    """組合單一合約的分析結果 (GEX / Risk Reversal 由 Greeks 表推得, Max Pain 由痛苦曲線推得)"""
+    if greeks is not None:
+        gex = calculate_dealer_gex(df_selected, spot_price, settlement_date, greeks=greeks)
+        atm_iv, risk_reversal, atm_strike = calculate_risk_reversal(df_selected, spot_price, settlement_date, greeks=greeks)
+        gex_profile, gamma_flip = calculate_gex_profile(greeks, spot_price, settlement_date)
+    else:
+        gex, atm_iv, risk_reversal, atm_strike = None, None, None, None
+        gex_profile, gamma_flip = None, None
+    return {
+        'data_date': data_date,
+        'contract': contract_code,
+        'settlement_date': settlement_date,
+        'spot': spot_price,
+        'df': df_selected,
+        'call_amount': call_amt,
+        'put_amount': put_amt,
+        'pc_ratio': (put_amt / call_amt * 100) if call_amt > 0 else 0,
+        'gex': gex,
+        'gex_profile': gex_profile,
+        'gamma_flip': gamma_flip,
+        'atm_iv': atm_iv,
+        'risk_reversal': risk_reversal,
+        'atm_strike': atm_strike,
+        'pain_curve': pain_curve,
+        'max_pain': max_pain_by_contract(pain_curve).get(contract_code),
+    }
+
+def analyze_contract(all_option_data, contract_code, spot_price):
+    """單一合約的未平倉 / P/C 金額比 / GEX / Risk Reversal (逐合約版本, 供對照批次結果)"""
+    data_date = all_option_data[0]['date']
+    df_full = calculate_multi_day_oi_change(all_option_data)
+    df_selected = df_full[df_full['Month'] == contract_code].copy()
+    if df_selected.empty:
+        return None
+    settlement_date = df_selected['Settlement'].iloc[0]
+    is_call = df_selected['is_call']
+    call_amt = df_selected.loc[is_call, 'Amount'].sum()
+    put_amt = df_selected.loc[~is_call, 'Amount'].sum()
+    greeks = calculate_chain_greeks(df_selected, spot_price, settlement_date) if spot_price else None
+    pain_curve = calculate_pain_curve(df_selected)
+    return contract_result(data_date, contract_code, settlement_date, spot_price, df_selected, call_amt, put_amt, greeks, pain_curve)
+
+def precompute_contract_base(all_option_data):
+    """與現貨無關的部分一次計算: 未平倉變化、金額加總與痛苦曲線, 每個數據日只需算一次"""
+    data_date = all_option_data[0]['date']
+    df_full = calculate_multi_day_oi_change(all_option_data)
+    settlement_dates = {c['code']: c['date'] for c in get_next_contracts(df_full, data_date)}
+    df_open = df_full[df_full['Month'].isin(list(settlement_dates))]
+    amounts = df_open['Amount'].groupby([df_open['Month'], df_open['is_call']], observed=True).sum()
+    pain_by_month = dict(tuple(calculate_pain_curve(df_open).groupby('Month', sort=False, observed=True)))
+    return {
+        'data_date': data_date,
+        'df_open': df_open,
+        'settlement_dates': settlement_dates,
+        'amounts': amounts,
+        'pain_by_month': {code: pain.reset_index(drop=True) for code, pain in pain_by_month.items()},
+    }
+
+def precompute_contract_analytics(all_option_data, spot_price, base=None):
+    """所有未結算合約一次計算: Greeks 對整條報價鏈只算一次再依 Month 分組; base 可傳入已快取的現貨無關部分"""
+    base = base or precompute_contract_base(all_option_data)
+    df_open, settlement_dates, amounts = base['df_open'], base['settlement_dates'], base['amounts']
+    greeks_by_month = {}
+    if spot_price:
+        try:
+            greeks_all = calculate_chain_greeks(df_open, spot_price, settlement_dates)
+            greeks_by_month = {code: g.drop(columns='Month') for code, g in greeks_all.groupby('Month', sort=False, observed=True)}
+        except Exception:
+            pass
+    results = {}
+    for code, df_selected in df_open.groupby('Month', sort=False, observed=True):
+        results[code] = contract_result(
+            base['data_date'], code, settlement_dates[code], spot_price, df_selected.copy(),
+            amounts.get((code, True), 0.0), amounts.get((code, False), 0.0), greeks_by_month.get(code),
+            base['pain_by_month'][code]
+        )
+    return results
+
+def analytics_memory_bytes(results):
+    """批次結果佔用的記憶體 (DataFrame 深度計算)"""
+    total = 0
+    for result in results.values():
+        for key in ('df', 'gex', 'gex_profile', 'pain_curve'):
+            if result[key] is not None:
+                total += int(result[key].memory_usage(deep=True).sum())
+    return total
+
+class BatchLog:
+    """批次預算紀錄 (數據日 / 現貨 / 合約數 / 耗時 / 記憶體)"""
+
+    def __init__(self, max_records=50):
+        self.lock = threading.Lock()
+        self.records = deque(maxlen=max_records)
+
+    def record(self, data_date, spot_price, contracts, seconds, memory_bytes):
+        with self.lock:
+            self.records.append({
+                '數據日': data_date,
+                '現貨': spot_price,
+                '合約數': contracts,
+                '耗時(ms)': round(seconds * 1e3, 1),
+                '記憶體(KB)': round(memory_bytes / 1024, 1),
+            })
+
+    def summary(self):
+        with self.lock:
+            return pd.DataFrame(list(self.records)[::-1])
+
+@st.cache_resource
+def get_batch_log():
+    return BatchLog()
+
+def analytics_spot(spot_price):
+    """Greeks / GEX 計算用的現貨 (取整至 ANALYTICS_SPOT_BUCKET 點), 同時作為快取 key"""
+    return bucket_spot(spot_price, ANALYTICS_SPOT_BUCKET)
+
+@st.cache_data(ttl=300, max_entries=8, show_spinner=False)
+def get_contract_base(data_date, _all_option_data):
+    """每個數據日的現貨無關部分 (未平倉變化 / 金額 / 痛苦曲線), 現貨變動時不重算"""
+    return precompute_contract_base(_all_option_data)
+
+@st.cache_data(ttl=300, max_entries=16, show_spinner=False)
+def batch_contract_analytics(data_date, spot_key, _all_option_data):
+    start = time.perf_counter()
+    results = precompute_contract_analytics(_all_option_data, spot_key, base=get_contract_base(data_date, _all_option_data))
+    get_batch_log().record(data_date, spot_key, len(results), time.perf_counter() - start, analytics_memory_bytes(results))
+    return results
+
+def get_all_contract_analytics(data_date, spot_price, _all_option_data):
+    """每個 (數據日, 現貨區間) 批次預算一次所有合約, 切換合約與盤中現貨小幅跳動只需查表
+
+    結果中的 spot 為取整後實際用來計算 Greeks 的現貨。
+    """
+    return batch_contract_analytics(data_date, analytics_spot(spot_price), _all_option_data)
+
+@st.cache_data(ttl=300, max_entries=64, show_spinner=False)
+def contract_analytics_at(data_date, contract_code, spot_key, _all_option_data):
+    return batch_contract_analytics(data_date, spot_key, _all_option_data).get(contract_code)
+
+def get_contract_analytics(data_date, contract_code, spot_price, _all_option_data):
+    """每個 (數據日, 合約, 現貨區間) 的分析結果, 多個 session 與 API 請求共用"""
+    return contract_analytics_at(data_date, contract_code, analytics_spot(spot_price), _all_option_data)
+
+def prefetch_contract_analytics(data_date, spot_price, all_option_data):
+    """新數據日載入後在背景先跑批次, 使用者選好合約時結果通常已備妥"""
+    return submit_task(get_executor('batch', 1), get_all_contract_analytics, data_date, spot_price, all_option_data)
+
+@st.cache_resource
+def start_analytics_api(port):
+    """在 Streamlit 程序內啟動 JSON API (與頁面共用同一組快取), 每個程序只啟動一次"""
+    import api
+    return api.serve_in_background(sys.modules[__name__], port)
+
+# ==================== 盤中即時圖表 ====================
+def render_spot_charts(data_date, contract_code, df_selected, analytics, spot_price, live):
+    """龍捲風圖 / 痛苦曲線 / GEX 圖; live 時以盤中輪詢的最新現貨移動現貨線"""
+    if live:
+        tick = get_live_tick()
+        if tick:
+            spot_price = tick['taiex'] or spot_price
+            futures = f" | 台指期 {tick['futures']:,.0f} (基差 {tick['futures'] - spot_price:+,.0f})" if tick['futures'] and spot_price else ""
+            stamp = datetime.fromtimestamp(tick['ts'], tz=TW_TZ).strftime('%H:%M:%S')
+            st.caption(f"🟢 盤中即時: 現貨 {spot_price:,.2f}{futures} | {stamp} 每 {INTRADAY_POLL_SECONDS} 秒更新")
+    
+    col_tornado, col_pain = st.columns([3, 2])
+    with col_tornado:
+        fig = tornado_figure(data_date, contract_code, df_selected, spot_price)
+        st.plotly_chart(fig, use_container_width=True)
+    with col_pain:
+        fig_pain = pain_figure(data_date, contract_code, analytics['pain_curve'], analytics['max_pain'], spot_price)
+        st.plotly_chart(fig_pain, use_container_width=True)
+    
+    # GEX 分析
+    fig_gex, fig_profile = gex_figures(data_date, contract_code, analytics, spot_price)
+    if fig_gex:
+        st.plotly_chart(fig_gex, use_container_width=True)
+    if fig_profile:
+        flip = analytics['gamma_flip']
+        st.caption(
+            f"⚖️ Gamma 翻轉點: **{flip:,.0f}** ({'現貨在上方, 莊家避險抑制波動' if spot_price > flip else '現貨在下方, 莊家避險放大波動'})"
+            if flip else f"⚖️ 現貨 ±{GEX_PROFILE_RANGE} 點內無 Gamma 翻轉點"
+        )
+        st.plotly_chart(fig_profile, use_container_width=True)
 
 # ==================== 主程式 ====================
 def main():
@@ -725,6 +2472,10 @@ def main():
     if 'all_contracts' not in st.session_state:
         st.session_state.all_contracts = None
     
+    if ANALYTICS_API_PORT:
+        start_analytics_api(int(ANALYTICS_API_PORT))
+    get_intraday_poller()
+    
     # 注入廣告與 PWA
     inject_adsense_head()
     inject_pwa_support()
@@ -733,13 +2484,42 @@ def main():
     
     # 側邊欄設定
     if st.sidebar.button("🔄 重新整理"):
-        st.cache_data.clear()
-        st.session_state.show_analysis_results = False
-        st.session_state.selected_contract = None
-        st.session_state.all_contracts = None
-        st.rerun()
+        wait_left = REFRESH_COOLDOWN - (time.time() - st.session_state.get('last_refresh_at', 0))
+        if wait_left > 0:
+            st.sidebar.warning(f"⏳ 請於 {int(wait_left) + 1} 秒後再重新整理")
+        else:
+            st.session_state.last_refresh_at = time.time()
+            with st.spinner("🔄 正在檢查最新數據..."):
+                refresh_stale_datasets()
+            st.session_state.show_analysis_results = False
+            st.session_state.selected_contract = None
+            st.session_state.all_contracts = None
+            st.rerun()
     
-    st.sidebar.caption(f"Gemini: {'✅' if gemini_model else '❌'} | ChatGPT: {'✅' if openai_client else '❌'}")
+    ai_clients = get_ai_clients()
+    st.sidebar.caption(
+        f"Gemini: {ai_client_badge(ai_clients.gemini[0], GEMINI_KEY)} | "
+        f"ChatGPT: {ai_client_badge(ai_clients.openai, OPENAI_KEY)}"
+    )
+    
+    with st.sidebar.expander("⚙️ 系統狀態"):
+        flight_stats = single_flight_stats()
+        if flight_stats.empty:
+            st.caption("尚無請求")
+        else:
+            st.dataframe(flight_stats, hide_index=True, use_container_width=True)
+        swr_status = cache_status()
+        if not swr_status.empty:
+            st.dataframe(swr_status, hide_index=True, use_container_width=True)
+        endpoints = upstream_status()
+        if not endpoints.empty:
+            st.dataframe(endpoints, hide_index=True, use_container_width=True)
+        ai_latency = get_ai_latency_log().summary()
+        if not ai_latency.empty:
+            st.dataframe(ai_latency, hide_index=True, use_container_width=True)
+        batch_log = get_batch_log().summary()
+        if not batch_log.empty:
+            st.dataframe(batch_log.head(5), hide_index=True, use_container_width=True)
     
     # 現貨價格設定
     st.markdown("### 📊 現貨價格設定")
@@ -766,7 +2546,12 @@ def main():
         st.markdown("### 📋 步驟 1: 載入選擇權數據")
         
         with st.spinner("🔄 正在載入數據..."):
-            all_option_data = get_option_data_multi_days(days=2)
+            try:
+                all_option_data = get_option_data_multi_days(days=OI_HISTORY_DAYS)
+            except UpstreamError:
+                st.error("❌ 期交所連線失敗或逾時")
+                st.info("請稍後按「🔄 重新整理」再試")
+                return
         
         if not all_option_data:
             st.error("❌ 無法取得選擇權數據")
@@ -789,6 +2574,7 @@ def main():
         st.session_state.all_contracts = all_contracts
         st.session_state.all_option_data = all_option_data
         st.session_state.data_date = data_date
+        prefetch_contract_analytics(data_date, manual_spot or get_live_spot(), all_option_data)
         st.rerun()
     
     # 步驟2: 選擇合約
@@ -840,30 +2626,26 @@ def main():
         
         # 抓取其他數據
         with st.spinner("🔄 正在更新數據..."):
-            taiex_now = get_realtime_data()
-            futures_price, futures_volume, fut_date = get_futures_data()
-            inst_fut_position = get_institutional_futures_position()
-            inst_opt_data = get_institutional_option_data()
+            snapshot = fetch_market_snapshot()
+            taiex_now = snapshot['taiex']
+            futures_price, futures_volume, fut_date = snapshot['futures']
+            inst_fut_position = snapshot['inst_fut']
+            inst_opt_data = snapshot['inst_opt']
         
         # 處理手動輸入
         if manual_spot > 0:
             taiex_now = manual_spot
         
-        # 過濾選定合約的數據
-        df_full = calculate_multi_day_oi_change(all_option_data)
-        df_selected = df_full[df_full['Month'] == selected_code].copy()
+        # 選定合約的分析結果 (未平倉變化 / P/C 金額比 / GEX / Risk Reversal)
+        analytics = get_contract_analytics(data_date, selected_code, taiex_now, all_option_data)
         
-        if df_selected.empty:
+        if analytics is None:
             st.error(f"❌ 找不到 {selected_code} 的數據")
             return
         
+        df_selected = analytics['df']
         basis = (futures_price - taiex_now) if (taiex_now and futures_price) else None
         
-        # 計算 P/C 金額比
-        call_amt = df_selected[df_selected['Type'].str.contains('Call|買')]['Amount'].sum()
-        put_amt = df_selected[df_selected['Type'].str.contains('Put|賣')]['Amount'].sum()
-        pc_ratio = (put_amt / call_amt * 100) if call_amt > 0 else 0
-        
         st.sidebar.download_button(
             "📥 下載數據", 
             df_selected.to_csv(index=False).encode('utf-8-sig'), 
@@ -927,7 +2709,7 @@ def main():
                         })
         
         if institutional_display:
-            st.caption(f"📅 期貨籌碼日期: {fut_data_date} | 選擇權籌碼日期: {opt_data_date}")
+            st.caption(f"📅 期貨籌碼日期: {fut_data_date} | 選擇權籌碼日期: {opt_data_date} | 資料更新於 {int(snapshot['age'])} 秒前")
             st.dataframe(
                 pd.DataFrame(institutional_display), 
                 use_container_width=True, 
@@ -941,24 +2723,48 @@ def main():
         # 龍捲風圖
         st.markdown(f"### 📊 {selected_code} 未平倉分佈 (結算: {settlement_date})")
         
-        fig = plot_tornado_chart(df_selected, f"{selected_code} 合約", taiex_now)
-        st.plotly_chart(fig, use_container_width=True)
+        if analytics['max_pain']:
+            st.metric("🎯 Max Pain (結算痛苦點)", f"{analytics['max_pain']:,}",
+                      delta=f"{analytics['max_pain'] - taiex_now:+,.0f} 點 (相對現貨)" if taiex_now else None,
+                      delta_color="off")
         
-        # GEX 分析
-        gex_data = calculate_dealer_gex(df_selected, taiex_now, settlement_date)
-        if gex_data is not None:
-            fig_gex = plot_gex_chart(gex_data, taiex_now)
-            if fig_gex:
-                st.plotly_chart(fig_gex, use_container_width=True)
+        # 盤中由輪詢緩衝區更新現貨線 (只重跑圖表片段, 不重新執行整個頁面)
+        live = manual_spot <= 0 and is_intraday_session()
+        st.fragment(run_every=INTRADAY_POLL_SECONDS if live else None)(render_spot_charts)(
+            data_date, selected_code, df_selected, analytics, taiex_now, live
+        )
+        
+        # 近 20 日未平倉歷史 (開啟時才載入, 已入庫日期不重抓)
+        if st.toggle(f"📈 顯示近 {OI_HISTORY_VIEW_DAYS - 1} 日未平倉歷史"):
+            with st.spinner("🔄 正在載入歷史數據..."):
+                try:
+                    history_data = get_option_data_multi_days(days=OI_HISTORY_VIEW_DAYS) or []
+                except UpstreamError:
+                    history_data = None
+                    st.error("❌ 期交所連線失敗或逾時, 請稍後再試")
+            history_table, peaks = (None, None)
+            if history_data:
+                history_table, peaks = get_oi_history_view(history_data[0]['date'], selected_code, len(history_data), history_data)
+            if history_table is None:
+                # 連線失敗時上方已顯示錯誤, 不再重複警告
+                if history_data is not None:
+                    st.warning("⚠️ 查無歷史未平倉數據")
+            else:
+                st.caption(f"📅 {peaks.index[0]} ~ {peaks.index[-1]} 共 {len(peaks)} 個交易日 | Buildup_Days: 連續增倉天數")
+                st.plotly_chart(plot_peak_oi_chart(peaks, taiex_now, f"{selected_code} 最大未平倉履約價變化"), use_container_width=True)
+                st.dataframe(history_table, use_container_width=True, hide_index=True)
         
         st.markdown("---")
         
         # AI 分析區
         st.markdown("### 🤖 AI 莊家控盤分析")
         
-        if not gemini_model and not openai_client:
+        if not GEMINI_KEY and not OPENAI_KEY:
             st.error("❌ 未設定 AI API Key,無法使用分析功能")
         else:
+            # 使用者看廣告時先在背景建立 AI 用戶端
+            get_ai_clients().prefetch()
+            
             # 廣告解鎖機制
             if not st.session_state.analysis_unlocked:
                 st.info("📺 請觀看廣告 5 秒後解鎖 AI 分析功能")
@@ -980,38 +2786,75 @@ def main():
                         st.rerun()
             else:
                 # AI 功能已解鎖
+                gemini_model, gemini_name = get_gemini()
+                openai_client = get_openai()
+                if not gemini_model and not openai_client:
+                    st.error(f"❌ AI 模型無法使用: {gemini_name}")
+                
                 col_ai1, col_ai2 = st.columns(2)
                 
                 with col_ai1:
                     if st.button("🔮 Gemini 分析", disabled=not gemini_model, use_container_width=True):
                         st.session_state.show_analysis_results = True
                         st.session_state.ai_provider = 'gemini'
+                        st.session_state.ai_spot = taiex_now
                 
                 with col_ai2:
                     if st.button("💬 ChatGPT 分析", disabled=not openai_client, use_container_width=True):
                         st.session_state.show_analysis_results = True
                         st.session_state.ai_provider = 'chatgpt'
+                        st.session_state.ai_spot = taiex_now
+                
+                if st.button("⚡ 雙引擎分析 (同時詢問, 先到先顯示)", disabled=not (gemini_model and openai_client), use_container_width=True):
+                    st.session_state.show_analysis_results = True
+                    st.session_state.ai_provider = 'hedged'
+                    st.session_state.ai_spot = taiex_now
                 
                 if st.session_state.show_analysis_results:
-                    atm_iv, risk_reversal, atm_strike = calculate_risk_reversal(df_selected, taiex_now, settlement_date)
-                    gex_summary = calculate_dealer_gex(df_selected, taiex_now, settlement_date)
+                    provider = st.session_state.ai_provider
+                    # 以按下分析時的現貨為準: 盤中現貨持續跳動, 之後的 rerun 仍命中同一份快取結果
+                    ai_spot = st.session_state.get('ai_spot') or taiex_now
+                    ai_basis = (futures_price - ai_spot) if (ai_spot and futures_price) else None
                     
-                    ai_data = prepare_ai_data(
-                        df_selected, inst_opt_data, inst_fut_position, 
-                        futures_price, taiex_now, basis, 
-                        atm_iv, risk_reversal, gex_summary, data_date
-                    )
+                    def build_prompt():
+                        ai_data = prepare_ai_data(
+                            df_selected, inst_opt_data, inst_fut_position, 
+                            futures_price, ai_spot, ai_basis, 
+                            analytics['atm_iv'], analytics['risk_reversal'], analytics['gex'], data_date,
+                            max_pain=analytics['max_pain']
+                        )
+                        return build_ai_prompt(ai_data, ai_spot)
                     
-                    prompt = build_ai_prompt(ai_data, taiex_now)
+                    st.markdown("#### 📊 AI 分析結果")
+                    status_placeholder = st.empty()
+                    result_placeholder = st.empty()
+                    provider_label = AI_PROVIDER_LABELS.get(provider, provider)
+                    status_placeholder.caption(f"🤖 {provider_label} 分析中...")
+                    
+                    stream_to_page = lambda text: result_placeholder.markdown(text + " ▌")
+                    others = {}
+                    if provider == 'hedged':
+                        cache_keys = {p: ai_result_key(p, data_date, selected_code, ai_spot) for p in ('gemini', 'chatgpt')}
+                        provider, result, others = ask_ai_hedged(cache_keys, build_prompt, on_token=stream_to_page)
+                        provider_label = AI_PROVIDER_LABELS[provider]
+                    else:
+                        cache_key = ai_result_key(provider, data_date, selected_code, ai_spot)
+                        result = ask_ai_cached(provider, cache_key, build_prompt, on_token=stream_to_page)
                     
-                    with st.spinner(f"🤖 {st.session_state.ai_provider.upper()} 分析中..."):
-                        if st.session_state.ai_provider == 'gemini':
-                            result = ask_gemini(prompt)
-                        else:
-                            result = ask_chatgpt(prompt)
-                        
-                        st.markdown("#### 📊 AI 分析結果")
-                        st.markdown(result)
+                    if result['cached']:
+                        status_placeholder.caption(f"⚡ {provider_label}: 相同數據日與合約的分析結果 (快取)")
+                    elif result['total'] is not None:
+                        status_placeholder.caption(f"⏱️ {provider_label}: 首字 {result['ttft']:.1f} 秒 | 完成 {result['total']:.1f} 秒")
+                    else:
+                        status_placeholder.empty()
+                    result_placeholder.markdown(result['text'])
+                    
+                    for other_provider, future in others.items():
+                        with st.expander(f"🆚 對照: {AI_PROVIDER_LABELS[other_provider]}"):
+                            polling = not future.done()
+                            st.fragment(run_every=AI_HEDGE_POLL_SECONDS if polling else None)(render_hedge_result)(
+                                other_provider, future, polling
+                            )
         
         # 廣告區
         st.markdown("---")
@@ -0,0 +1,405 @@
+"""效能基準測試
+
+用法: python benchmarks.py [名稱 ...]          (不帶參數則全部執行)
+      python benchmarks.py --capture YYYY/MM/DD  (將該日期貨 / 選擇權報表頁面存到 fixtures/, 供 parse 核對)
+"""
+import glob
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import app_fixed as app
+
+SPOT = 22000.0
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def make_chain(spot=SPOT, months=('202501W2', '202501', '202502'), step=50, width=3000, seed=0):
+    """產生近似 TXO 的合成報價鏈 (含波動率微笑, 價格取到 0.1 點)"""
+    rng = np.random.default_rng(seed)
+    strikes = np.arange(spot - width, spot + width + step, step)
+    rows = []
+    for m_idx, month in enumerate(months):
+        t = (m_idx + 1) * 7 / 365.0
+        for is_call in (True, False):
+            moneyness = np.log(strikes / spot)
+            vol = 0.18 + 0.6 * moneyness ** 2 - 0.15 * moneyness
+            price, _ = app._bs_price_vega(spot, strikes, t, vol, is_call, 0.015)
+            price = np.maximum(np.round(price, 1), 0.1)
+            rows.append(pd.DataFrame({
+                'Month': month,
+                'Strike': strikes,
+                'Type': '買權' if is_call else '賣權',
+                'OI': rng.integers(0, 20000, strikes.size).astype(float),
+                'Price': price,
+                'T': t,
+            }))
+    df = pd.concat(rows, ignore_index=True)
+    df['Amount'] = df['OI'] * df['Price'] * 50
+    return df
+
+
+def make_page(table_html):
+    """包上近似期交所頁面的導覽列與查詢表單, 讓解析器必須略過無關內容"""
+    nav = "".join(f'<li><a href="/cht/{i}">選單項目 {i}</a></li>' for i in range(400))
+    form = '<form><label>日期</label><input name="queryDate"><select name="commodity_id"><option>TXO</option></select></form>'
+    return f"<html><head><title>期交所</title></head><body><ul>{nav}</ul>{form}{table_html}</body></html>"
+
+
+def make_option_report_html(df):
+    """optDailyMarketReport 格式的合成頁面"""
+    headers = ['契約', '到期月份(週別)', '履約價', '買賣權', '開盤價', '最高價', '最低價', '最後成交價', '結算價',
+               '漲跌價', '漲跌%', '盤後交易時段成交量', '一般交易時段成交量', '合計成交量', '未沖銷契約量',
+               '最後最佳買價', '最後最佳賣價', '歷史最高價', '歷史最低價']
+    rows = []
+    for r in df.itertuples():
+        price = '-' if r.Price < 0.2 else f"{r.Price:,.1f}"
+        cells = ['TXO', r.Month, f"{int(r.Strike):,}", '買權' if '買' in r.Type else '賣權', price, price, price, price,
+                 price, '-', '-', '0', f"{int(r.OI) // 3:,}", f"{int(r.OI) // 3:,}", f"{int(r.OI):,}", '-', '-', '-', '-']
+        rows.append("<tr>" + "".join(f"<td>{c}</td>" for c in cells) + "</tr>")
+    head = "<tr>" + "".join(f"<th>{h}</th>" for h in headers) + "</tr>"
+    return make_page(f'<table class="table_c">{head}{"".join(rows)}</table>')
+
+
+def make_institutional_options_html(seed=0):
+    """callsAndPutsDate 格式 (含 rowspan/colspan 多層表頭) 的合成頁面"""
+    rng = np.random.default_rng(seed)
+    head = ('<tr><th rowspan="2">序號</th><th rowspan="2">商品名稱</th><th rowspan="2">權別</th><th rowspan="2">身份別</th>'
+            '<th colspan="6">交易口數與契約金額</th><th colspan="6">未平倉餘額</th></tr>'
+            '<tr>' + '<th>買方 口數</th><th>買方 契約金額</th><th>賣方 口數</th><th>賣方 契約金額</th>'
+            '<th>買賣差額 口數</th><th>買賣差額 契約金額</th>' * 2 + '</tr>')
+    body = []
+    for commodity in ('臺指選擇權', '電子選擇權'):
+        for o, option_type in enumerate(('買權', '賣權')):
+            for i, inst in enumerate(('自營商', '投信', '外資')):
+                cells = []
+                if o == 0 and i == 0:
+                    cells.append('<td rowspan="6">1</td><td rowspan="6">%s</td>' % commodity)
+                if i == 0:
+                    cells.append('<td rowspan="3">%s</td>' % option_type)
+                nums = rng.integers(-50000, 50000, 12)
+                cells.append(f'<td>{inst}</td>' + "".join(f"<td>{n:,}</td>" for n in nums))
+                body.append("<tr>" + "".join(cells) + "</tr>")
+    return make_page(f'<table class="table_f">{head}{"".join(body)}</table>')
+
+
+def make_institutional_futures_html(seed=0):
+    """futContractsDate queryType=2 格式 (三大法人期貨交易與未平倉) 的合成頁面"""
+    rng = np.random.default_rng(seed)
+    head = ('<tr><th rowspan="2">序號</th><th rowspan="2">商品名稱</th><th rowspan="2">身份別</th>'
+            '<th colspan="6">交易口數與契約金額</th><th colspan="6">未平倉餘額</th></tr>'
+            '<tr>' + '<th>多方 口數</th><th>多方 契約金額</th><th>空方 口數</th><th>空方 契約金額</th>'
+            '<th>多空淨額 口數</th><th>多空淨額 契約金額</th>' * 2 + '</tr>')
+    body = []
+    for c, commodity in enumerate(('臺股期貨', '電子期貨', '小型臺指期貨')):
+        for i, inst in enumerate(('自營商', '投信', '外資')):
+            cells = '<td rowspan="3">%d</td><td rowspan="3">%s</td>' % (c + 1, commodity) if i == 0 else ''
+            nums = rng.integers(-80000, 80000, 12)
+            body.append(f"<tr>{cells}<td>{inst}</td>" + "".join(f"<td>{n:,}</td>" for n in nums) + "</tr>")
+    return make_page(f'<table class="table_f">{head}{"".join(body)}</table>')
+
+
+def make_futures_price_html(price=22050.0):
+    """futContractsDate queryType=1 格式 (各月份行情) 的合成頁面"""
+    headers = ['契約', '到期月份(週別)', '開盤價', '最高價', '最低價', '收盤價', '漲跌價', '漲跌%', '成交量', '結算價', '未沖銷契約量']
+    rows = []
+    for m, month in enumerate(('202611', '202612', '202703')):
+        p = price + m * 15
+        cells = ['TX', month, f"{p - 40:,.0f}", f"{p + 60:,.0f}", f"{p - 80:,.0f}", f"{p:,.0f}", '12', '0.05%', '85,000', f"{p:,.0f}", '90,000']
+        rows.append("<tr>" + "".join(f"<td>{c}</td>" for c in cells) + "</tr>")
+    head = "<tr>" + "".join(f"<th>{h}</th>" for h in headers) + "</tr>"
+    return make_page(f'<table class="table_c">{head}{"".join(rows)}</table>')
+
+
+def td_header(html):
+    """表頭改用 <td> 的版本 (核對表頭偵測不依賴 <th>)"""
+    return html.replace('<th', '<td').replace('</th>', '</td>')
+
+
+def timeit(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+IMPORT_BUDGET_MS = 1500
+LAZY_MODULES = ('google.generativeai', 'openai', 'scipy.stats', 'scipy.special')
+
+
+def bench_import():
+    """冷啟動匯入時間 (python -X importtime), 並確認重量級套件延遲載入"""
+    code = ("import sys, app_fixed; "
+            f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))")
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cum, name = line[len('import time:'):].split('|')
+        # 只統計 app_fixed 直接匯入的模組 (縮排一層)
+        if cum.strip().isdigit() and (name.strip() == 'app_fixed' or name.startswith('   ') and not name.startswith('    ')):
+            cumulative[name.strip()] = int(cum)
+    total_ms = cumulative.pop('app_fixed', 0) / 1e3
+    top = sorted(((v, k) for k, v in cumulative.items()), reverse=True)[:8]
+    loaded = proc.stdout.strip().splitlines()[-1] if proc.stdout.strip() else ''
+    print(f"import app_fixed: {total_ms:.0f} ms (budget {IMPORT_BUDGET_MS} ms) {'OK' if total_ms <= IMPORT_BUDGET_MS else 'OVER BUDGET'}")
+    for us, name in top:
+        print(f"  {us / 1e3:8.1f} ms  {name}")
+    print(f"eagerly loaded heavy modules: {loaded or 'none'}")
+
+
+def bench_iv():
+    """整條報價鏈 IV: 逐筆 calculate_iv vs calculate_iv_vectorized"""
+    df = make_chain()
+    is_call = app.is_call_type(df['Type'])
+
+    def scalar():
+        return [
+            app.calculate_iv(p, SPOT, k, t, 'call' if c else 'put')
+            for p, k, t, c in zip(df['Price'], df['Strike'], df['T'], is_call)
+        ]
+
+    def vectorized():
+        return app.calculate_iv_vectorized(df['Price'].to_numpy(), SPOT, df['Strike'].to_numpy(), df['T'].to_numpy(), is_call)
+
+    t_scalar = timeit(scalar, repeat=1)
+    t_vec = timeit(vectorized)
+    iv_scalar = np.array([np.nan if v is None else v for v in scalar()])
+    iv_vec = vectorized()
+    both = np.isfinite(iv_scalar) & np.isfinite(iv_vec)
+    print(f"rows={len(df)}  scalar={t_scalar * 1e3:.1f} ms  vectorized={t_vec * 1e3:.2f} ms  speedup={t_scalar / t_vec:.0f}x")
+    print(f"solved: scalar={np.isfinite(iv_scalar).sum()}  vectorized={np.isfinite(iv_vec).sum()}  "
+          f"max|diff|={np.abs(iv_scalar[both] - iv_vec[both]).max():.2e}")
+
+
+def check_option_report(html):
+    fast = app.parse_option_daily_report(html)
+    slow = app.parse_option_daily_report_read_html(html)
+    pd.testing.assert_frame_equal(fast.reset_index(drop=True), slow.reset_index(drop=True), check_dtype=False)
+    return len(fast)
+
+
+def check_institutional_options(html):
+    fast, slow = app.parse_institutional_options(html), app.parse_institutional_options_read_html(html)
+    assert fast == slow, (fast, slow)
+    return len(fast)
+
+
+def check_institutional_futures(html):
+    fast, slow = app.parse_institutional_futures(html), app.parse_institutional_futures_read_html(html)
+    assert fast == slow, (fast, slow)
+    return len(fast)
+
+
+def check_futures_price(html):
+    fast, slow = app.parse_futures_price(html), app.parse_futures_price_read_html(html)
+    assert fast == slow, (fast, slow)
+    return fast
+
+
+# 擷取頁面: (檔名前綴, url, payload)
+FIXTURE_PAGES = [
+    ('optDailyMarketReport', "https://www.taifex.com.tw/cht/3/optDailyMarketReport",
+     {'queryType': '2', 'marketCode': '0', 'commodity_id': 'TXO', 'MarketCode': '0', 'commodity_idt': 'TXO'}),
+    ('futContractsDate_q1', "https://www.taifex.com.tw/cht/3/futContractsDate",
+     {'queryType': '1', 'marketCode': '0', 'commodity_id': 'TX'}),
+    ('futContractsDate_q2', "https://www.taifex.com.tw/cht/3/futContractsDate", {'queryType': '2', 'commodity_id': 'TX'}),
+    ('callsAndPutsDate', "https://www.taifex.com.tw/cht/3/callsAndPutsDate", {'queryType': '2', 'commodity_id': 'TXO'}),
+]
+FIXTURE_CHECKS = {
+    'optDailyMarketReport': check_option_report,
+    'futContractsDate_q1': check_futures_price,
+    'futContractsDate_q2': check_institutional_futures,
+    'callsAndPutsDate': check_institutional_options,
+}
+
+
+def capture_fixtures(query_date):
+    """抓取 query_date 的實際報表頁面存成 fixtures/<前綴>_<YYYYMMDD>.html"""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    for prefix, url, payload in FIXTURE_PAGES:
+        res = app.http_request('POST', url, data={**payload, 'queryDate': query_date})
+        res.encoding = 'utf-8'
+        path = os.path.join(FIXTURE_DIR, f"{prefix}_{query_date.replace('/', '')}.html")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(res.text)
+        print(f"saved {path} ({len(res.text):,} chars)")
+
+
+def bench_parse():
+    """報表解析: 目標表格解析器 vs 正式路徑的 read_html 解析 (合成頁面與 fixtures/ 實際頁面皆核對結果一致)"""
+    chain = make_chain()
+    html = make_option_report_html(chain)
+    rows = check_option_report(html)
+    pd.testing.assert_frame_equal(app.parse_option_daily_report(td_header(html)), app.parse_option_daily_report(html))
+    t_fast = timeit(lambda: app.parse_option_daily_report(html))
+    t_slow = timeit(lambda: app.parse_option_daily_report_read_html(html))
+    print(f"optDailyMarketReport rows={rows}  read_html={t_slow * 1e3:.1f} ms  "
+          f"targeted={t_fast * 1e3:.1f} ms  speedup={t_slow / t_fast:.1f}x")
+
+    html = make_institutional_options_html()
+    check_institutional_options(html)
+    assert app.parse_institutional_options(td_header(html)) == app.parse_institutional_options(html)
+    t_fast = timeit(lambda: app.parse_institutional_options(html))
+    t_slow = timeit(lambda: pd.read_html(app.StringIO(html)))
+    print(f"callsAndPutsDate  read_html={t_slow * 1e3:.1f} ms  targeted={t_fast * 1e3:.2f} ms  speedup={t_slow / t_fast:.1f}x")
+
+    html = make_institutional_futures_html()
+    check_institutional_futures(html)
+    assert app.parse_institutional_futures(td_header(html)) == app.parse_institutional_futures(html)
+    t_fast = timeit(lambda: app.parse_institutional_futures(html))
+    t_slow = timeit(lambda: pd.read_html(app.StringIO(html)))
+    print(f"futContractsDate  read_html={t_slow * 1e3:.1f} ms  targeted={t_fast * 1e3:.2f} ms  speedup={t_slow / t_fast:.1f}x")
+
+    html = make_futures_price_html()
+    check_futures_price(html)
+    assert app.parse_futures_price(td_header(html)) == app.parse_futures_price(html)
+
+    fixtures = sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html')))
+    print(f"TARGETED_PARSERS={'on' if app.TARGETED_PARSERS else 'off (production parses with read_html)'}")
+    if not fixtures:
+        print(f"no captured pages in {FIXTURE_DIR} (python benchmarks.py --capture YYYY/MM/DD); "
+              f"keep TARGETED_PARSERS off until they are committed and pass")
+    for path in fixtures:
+        name = os.path.basename(path)
+        check = FIXTURE_CHECKS.get(name.rsplit('_', 1)[0])
+        if check is None:
+            continue
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        print(f"fixture {name}: targeted == read_html ({check(html)})")
+
+
+def bench_batch():
+    """所有未結算合約分析: 逐合約 analyze_contract vs 批次 precompute_contract_analytics"""
+    chain = app.normalize_option_chain(make_chain(months=('209901W1', '209901W2', '209901', '209902', '209903', '209906')))
+    prev = chain.assign(OI=chain['OI'] * 9 // 10)
+    all_data = [{'date': '2098/12/31', 'df': chain}, {'date': '2098/12/30', 'df': prev}]
+    codes = chain['Month'].unique()
+    batch = app.precompute_contract_analytics(all_data, SPOT)
+    for code in codes:
+        single = app.analyze_contract(all_data, code, SPOT)
+        pd.testing.assert_frame_equal(single['df'], batch[code]['df'])
+        pd.testing.assert_frame_equal(single['gex'], batch[code]['gex'])
+        scalars = [[np.nan if r[k] is None else r[k] for k in ('pc_ratio', 'atm_iv', 'risk_reversal', 'max_pain')] for r in (single, batch[code])]
+        assert np.allclose(*scalars, equal_nan=True), code
+    t_loop = timeit(lambda: [app.analyze_contract(all_data, code, SPOT) for code in codes])
+    t_batch = timeit(lambda: app.precompute_contract_analytics(all_data, SPOT))
+    base = app.precompute_contract_base(all_data)
+    t_spot = timeit(lambda: app.precompute_contract_analytics(all_data, SPOT + app.ANALYTICS_SPOT_BUCKET, base=base))
+    print(f"contracts={len(codes)} rows={len(chain)}  per-contract={t_loop * 1e3:.1f} ms  batch={t_batch * 1e3:.1f} ms  "
+          f"speedup={t_loop / t_batch:.1f}x  memory={app.analytics_memory_bytes(batch) / 1024:.0f} KB")
+    print(f"new spot bucket (base cached)={t_spot * 1e3:.1f} ms")
+
+
+def merge_oi_change(all_data):
+    """舊版: 每個較舊的交易日各做一次 pd.merge (對照組)"""
+    df_latest = all_data[0]['df'].copy()
+    for i in range(1, len(all_data)):
+        df_merged = pd.merge(
+            df_latest[app.OI_HISTORY_KEYS + ['OI']], all_data[i]['df'][app.OI_HISTORY_KEYS + ['OI']],
+            on=app.OI_HISTORY_KEYS, how='left', suffixes=('', f'_D{i}')
+        )
+        df_latest[f'OI_Change_D{i}'] = df_merged['OI'] - df_merged[f'OI_D{i}'].fillna(0)
+    return df_latest
+
+
+def bench_history():
+    """N 日未平倉變化: 逐日 pd.merge vs 單次 unstack 的歷史矩陣"""
+    rng = np.random.default_rng(1)
+    base = app.normalize_option_chain(make_chain())
+    all_data = []
+    for day in range(app.OI_HISTORY_VIEW_DAYS):
+        df = base.sample(frac=0.97, random_state=day).sort_index()
+        df['OI'] = rng.integers(0, 20000, len(df))
+        all_data.append({'date': f'2099/01/{31 - day:02d}', 'df': df.reset_index(drop=True)})
+    for days in (2, 5, app.OI_HISTORY_VIEW_DAYS):
+        data = all_data[:days]
+        expected = merge_oi_change(data)
+        actual = app.calculate_multi_day_oi_change(data)
+        pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+        t_merge = timeit(lambda: merge_oi_change(data))
+        t_matrix = timeit(lambda: app.calculate_multi_day_oi_change(data))
+        print(f"days={days:2d}  merge={t_merge * 1e3:6.1f} ms  matrix={t_matrix * 1e3:5.1f} ms")
+    t_view = timeit(lambda: app.oi_history_view(all_data, '202501'))
+    print(f"{app.OI_HISTORY_VIEW_DAYS}-day view (D1/D5/D20, build-up, peak strikes)={t_view * 1e3:.1f} ms")
+
+
+def naive_pain(df):
+    """逐一假設結算價, 對每個履約價加總 (O(K^2) 對照組)"""
+    pains = {}
+    for month, chain in df.groupby('Month', observed=True):
+        rows = list(zip(chain['Strike'], chain['is_call'], chain['OI']))
+        for settle in sorted(chain['Strike'].unique()):
+            pains[(month, settle)] = sum(
+                oi * (max(settle - k, 0) if is_call else max(k - settle, 0)) for k, is_call, oi in rows
+            ) * 50
+    return pd.Series(pains)
+
+
+def bench_maxpain():
+    """所有合約 Max Pain: 分組累加 vs 逐一結算價雙迴圈"""
+    chain = app.normalize_option_chain(make_chain(months=('209901W1', '209901W2', '209901', '209902', '209903', '209906')))
+    curve = app.calculate_pain_curve(chain)
+    expected = naive_pain(chain)
+    assert np.allclose(curve.set_index(['Month', 'Strike'])['Pain'].to_numpy(), expected.to_numpy())
+    t_naive = timeit(lambda: naive_pain(chain), repeat=1)
+    t_cumsum = timeit(lambda: app.max_pain_by_contract(app.calculate_pain_curve(chain)))
+    print(f"contracts=6 rows={len(chain)}  naive={t_naive * 1e3:.0f} ms  cumsum={t_cumsum * 1e3:.1f} ms  "
+          f"speedup={t_naive / t_cumsum:.0f}x  max_pain={app.max_pain_by_contract(curve)}")
+
+
+GEX_PROFILE_BUDGET_MS = 100
+
+
+def bench_gex_profile():
+    """月選 GEX-現貨曲線 (±1500 點, 每 10 點): 廣播計算 vs 逐價位逐履約價 calculate_greeks"""
+    chain = app.normalize_option_chain(make_chain(months=('209901',)))
+    settlement = chain['Settlement'].iloc[0]
+    greeks = app.calculate_chain_greeks(chain, SPOT, settlement)
+    profile, flip = app.calculate_gex_profile(greeks, SPOT, settlement)
+    rows = greeks[np.isfinite(greeks['IV']) & (greeks['OI'] > 0)]
+    t = app.get_time_to_expiry(settlement)
+
+    def scalar_gex(spot):
+        total = 0.0
+        for k, iv, oi, is_call in zip(rows['Strike'], rows['IV'], rows['OI'], rows['is_call']):
+            _, gamma = app.calculate_greeks(spot, k, t, iv, 'call' if is_call else 'put')
+            total += (gamma or 0) * oi * (1 if is_call else -1) * spot ** 2 * 0.01
+        return total
+
+    sample = profile.iloc[::50]
+    start = time.perf_counter()
+    expected = [scalar_gex(spot) for spot in sample['Spot']]
+    t_scalar = (time.perf_counter() - start) / len(sample) * len(profile)
+    assert np.allclose(sample['GEX'], expected, rtol=1e-6)
+    t_vec = timeit(lambda: app.calculate_gex_profile(greeks, SPOT, settlement))
+    print(f"grid={len(profile)} x strikes={len(rows)}  scalar≈{t_scalar * 1e3:.0f} ms (extrapolated)  "
+          f"broadcast={t_vec * 1e3:.1f} ms (budget {GEX_PROFILE_BUDGET_MS} ms) "
+          f"{'OK' if t_vec * 1e3 <= GEX_PROFILE_BUDGET_MS else 'OVER BUDGET'}  flip={flip}")
+
+
+BENCHMARKS = {
+    'import': bench_import,
+    'iv': bench_iv,
+    'parse': bench_parse,
+    'batch': bench_batch,
+    'history': bench_history,
+    'maxpain': bench_maxpain,
+    'gex_profile': bench_gex_profile,
+}
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--capture']:
+        capture_fixtures(sys.argv[2])
+        sys.exit()
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()